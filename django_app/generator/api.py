@@ -0,0 +1,210 @@
+import hmac
+import json
+import os
+import time
+from functools import wraps
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from .catalog import picto_catalog
+from .models import BatchSubmission, ProductSubmission, THUMBNAIL_FIELDS
+from .views import (
+    ProductIconGenerator, create_submissions, get_streaming_content, get_thumbnail_urls, iter_render_products,
+    store_result
+)
+from . import render_cache
+
+
+def api_token_required(view):
+    """Require one of the API_TOKENS as `Authorization: Bearer <token>`; no CSRF for token clients"""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        tokens = getattr(settings, 'API_TOKENS', [])
+        if scheme.lower() != 'bearer' or not any(hmac.compare_digest(token.encode(), t.encode()) for t in tokens):
+            return JsonResponse({'error': 'Invalid or missing API token.'}, status=401)
+        return view(request, *args, **kwargs)
+    return csrf_exempt(wrapper)
+
+
+def resolve_local_path(path):
+    """Resolve a server-local product path, refusing anything outside API_LOCAL_ROOTS"""
+    real_path = os.path.realpath(path)
+    for root in getattr(settings, 'API_LOCAL_ROOTS', []):
+        root = os.path.realpath(root)
+        if real_path.startswith(root + os.sep) and os.path.isfile(real_path):
+            return real_path
+    raise ValueError(f'Path not allowed: {path}')
+
+
+def parse_manifest(manifest, files):
+    """Validate a bulk generation manifest
+
+    {
+        "vertical": ["bio_1x.webp", ...],           # up to 5, position 1 = bottom
+        "horizontal": [["CBD", "cbd1.webp"], ...],  # up to 5 (category, file) pairs
+        "products": [{"file": "<multipart field>"} | {"path": "/srv/pim/123.jpg"}, ...]
+    }
+
+    Returns (vertical selections, horizontal selections, products) where products are
+    (name, uploaded file or local path) pairs. Raises ValueError on invalid input.
+    """
+    if not isinstance(manifest, dict):
+        raise ValueError('Manifest must be a JSON object.')
+
+    vertical = manifest.get('vertical') or []
+    horizontal = manifest.get('horizontal') or []
+    products = manifest.get('products') or []
+    if not isinstance(vertical, list) or len(vertical) > 5:
+        raise ValueError('`vertical` must be a list of at most 5 picto files.')
+    if not isinstance(horizontal, list) or len(horizontal) > 5:
+        raise ValueError('`horizontal` must be a list of at most 5 [category, file] pairs.')
+    if not isinstance(products, list) or not products:
+        raise ValueError('`products` must be a non-empty list.')
+
+    vertical_files = {f for f, _ in picto_catalog.get_vertical_pictos()}
+    vertical_selections = []
+    for filename in vertical:
+        filename = filename or ''
+        if not isinstance(filename, str):
+            raise ValueError('Vertical pictos must be file names.')
+        if filename and filename not in vertical_files:
+            raise ValueError(f'Unknown vertical picto: {filename}')
+        vertical_selections.append(filename)
+    vertical_selections += [''] * (5 - len(vertical_selections))
+
+    horizontal_selections = []
+    for selection in horizontal:
+        if not selection:
+            selection = ('', '')
+        if (not isinstance(selection, (list, tuple)) or len(selection) != 2
+                or not all(isinstance(value, str) for value in selection if value)):
+            raise ValueError('Horizontal pictos must be [category, file] pairs.')
+        category, filename = selection
+        if category and filename and not picto_catalog.has_horizontal_picto(category, filename):
+            raise ValueError(f'Unknown horizontal picto: {category}/{filename}')
+        horizontal_selections.append((category or '', filename or ''))
+    horizontal_selections += [('', '')] * (5 - len(horizontal_selections))
+
+    product_sources = []
+    for product in products:
+        if not isinstance(product, dict):
+            raise ValueError('Products must be objects with a `file` or a `path`.')
+        if not all(isinstance(product.get(key) or '', str) for key in ('file', 'path')):
+            raise ValueError('Product `file` and `path` must be strings.')
+        if product.get('file'):
+            uploaded_file = files.get(product['file'])
+            if uploaded_file is None:
+                raise ValueError(f'Missing uploaded file: {product["file"]}')
+            product_sources.append((uploaded_file.name, uploaded_file))
+        elif product.get('path'):
+            local_path = resolve_local_path(product['path'])
+            product_sources.append((os.path.basename(local_path), local_path))
+        else:
+            raise ValueError('Products must have a `file` or a `path`.')
+
+    return vertical_selections, horizontal_selections, product_sources
+
+
+@api_token_required
+@require_POST
+def bulk_generate(request):
+    """API endpoint rendering a manifest of products, streaming one NDJSON line per image
+
+    The manifest is the JSON body, or the `manifest` field of a multipart request whose
+    files it references by field name. Each product line is sent as soon as the image
+    is rendered and saved; a final summary line closes the stream.
+    """
+    try:
+        if request.content_type == 'multipart/form-data':
+            manifest = json.loads(request.POST.get('manifest', ''))
+        else:
+            manifest = json.loads(request.body)
+        vertical_selections, horizontal_selections, product_sources = parse_manifest(manifest, request.FILES)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    started = time.perf_counter()
+    horizontal_fields = {}
+    for i, (category, filename) in enumerate(horizontal_selections, start=1):
+        horizontal_fields[f'horizontal_cat_{i}'] = category
+        horizontal_fields[f'horizontal_file_{i}'] = filename
+    batch = BatchSubmission.objects.create(
+        **{f'vertical_pos_{i}': filename for i, filename in enumerate(vertical_selections, start=1)},
+        **horizontal_fields,
+    )
+
+    # Store every product first so each line can carry its submission id
+    submissions = []
+    product_files = []
+    for name, source in product_sources:
+        if isinstance(source, str):
+            with open(source, 'rb') as local_file:
+                file_path = default_storage.save(f'products/{name}', File(local_file, name=name))
+        else:
+            file_path = default_storage.save(f'products/{name}', source)
+        submissions.append(ProductSubmission(batch=batch, product_image=file_path))
+    with transaction.atomic():
+        submissions = create_submissions(submissions)
+    for submission, (_, source) in zip(submissions, product_sources):
+        # Uploads are decoded from the request; stored copies are opened on first read
+        product_files.append(submission.product_image if isinstance(source, str) else source)
+
+    index_of = {submission.pk: index for index, submission in enumerate(submissions)}
+
+    def stream():
+        generator = ProductIconGenerator()
+        succeeded = 0
+        try:
+            for submission, key, result_path, seconds in iter_render_products(
+                generator, submissions, product_files, vertical_selections, horizontal_selections,
+                batch_id=batch.id, parallel=settings.RENDER_MODE == 'parallel'
+            ):
+                line = {
+                    'type': 'product',
+                    'index': index_of[submission.pk],
+                    'batch_id': batch.id,
+                    'submission_id': submission.pk,
+                }
+                if store_result(submission, result_path):
+                    with transaction.atomic():
+                        submission.save(update_fields=['result_image', *THUMBNAIL_FIELDS])
+                        render_cache.store_many([(key, result_path)] if key else [])
+                    succeeded += 1
+                    line.update({
+                        'status': 'done',
+                        'result_url': request.build_absolute_uri(submission.result_image.url),
+                        'thumbnail_urls': {
+                            size: request.build_absolute_uri(url)
+                            for size, url in get_thumbnail_urls(submission).items()
+                        },
+                        'cached': key is None and seconds == 0,
+                    })
+                else:
+                    line['status'] = 'failed'
+                line.update({
+                    'render_ms': round(seconds * 1000, 1),
+                    'elapsed_ms': round((time.perf_counter() - started) * 1000, 1),
+                })
+                yield json.dumps(line) + '\n'
+        finally:
+            for product_file in product_files:
+                product_file.close()
+
+        yield json.dumps({
+            'type': 'summary',
+            'batch_id': batch.id,
+            'total': len(submissions),
+            'succeeded': succeeded,
+            'failed': len(submissions) - succeeded,
+            'elapsed_ms': round((time.perf_counter() - started) * 1000, 1),
+        }) + '\n'
+
+    response = StreamingHttpResponse(get_streaming_content(request, stream()), content_type='application/x-ndjson')
+    # Let reverse proxies pass each line through as it is written
+    response['X-Accel-Buffering'] = 'no'
+    return response
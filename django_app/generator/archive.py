@@ -0,0 +1,48 @@
+import zipfile
+from django.core.files.storage import default_storage
+
+
+class ZipStreamBuffer:
+    """Write-only file object that hands what zipfile wrote back to the caller
+
+    It has no tell()/seek(), so zipfile writes sizes in data descriptors after each
+    entry instead of seeking back, which is what allows streaming the archive.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip(entries, chunk_size=64 * 1024):
+    """Yield a ZIP archive of storage files chunk by chunk
+
+    `entries` are (name in the archive, storage name, date_time) tuples. Entries are
+    stored uncompressed: the results are WebP files, deflating them gains nothing.
+    At most one chunk of one file is held in memory at a time.
+    """
+    buffer = ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for arcname, name, date_time in entries:
+            info = zipfile.ZipInfo(arcname, date_time=date_time)
+            info.compress_type = zipfile.ZIP_STORED
+            info.file_size = default_storage.size(name)
+
+            with default_storage.open(name, 'rb') as source, archive.open(info, 'w') as target:
+                for chunk in source.chunks(chunk_size):
+                    target.write(chunk)
+                    yield buffer.pop()
+            yield buffer.pop()
+    # Central directory
+    yield buffer.pop()
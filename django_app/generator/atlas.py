@@ -0,0 +1,235 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import threading
+import time
+from django.conf import settings
+from PIL import Image
+from .catalog import picto_catalog
+from .layouts import get_render_plan
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: no lock between processes building the atlas at the same time
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+# Width of the atlas image; pictos are packed left to right in rows of their size
+ATLAS_WIDTH = 2048
+
+
+def get_atlas_dir():
+    return getattr(settings, 'PICTO_ATLAS_DIR', None) or os.path.join(
+        os.path.dirname(os.path.dirname(__file__)), 'cache'
+    )
+
+
+def get_atlas_sizes():
+    """Picto sizes (longest side) packed in the atlas: those of the render layout and PICTO_ATLAS_SIZES"""
+    return sorted(set(get_render_plan().picto_sizes) | set(getattr(settings, 'PICTO_ATLAS_SIZES', [])))
+
+
+class PictoAtlas:
+    """Every picto, pre-resized, in one raw RGBA file memory-mapped by each process
+
+    `manage.py build_picto_atlas` (or the first process noticing a change in Data/)
+    writes `<PICTO_ATLAS_DIR>/picto_atlas-<signature>.rgba` and `picto_atlas.json`,
+    the index of the picto boxes. Pictos are cropped out of the mapping without
+    decoding, and since the file is mapped read-only every worker of the host
+    shares the same physical pages.
+
+    The signature covers the path, mtime and size of every picto file and the
+    atlas sizes; it is checked at most every PICTO_CATALOG_CHECK_INTERVAL seconds.
+    While the atlas is stale, get() returns None and pictos are decoded as before.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index = None
+        self._image = None
+        self._checked_at = 0
+        self._rebuilding = False
+
+    def is_enabled(self):
+        return getattr(settings, 'PICTO_ATLAS_ENABLED', True)
+
+    def _get_picto_paths(self):
+        """Absolute path of every picto of the catalog"""
+        paths = [os.path.join(picto_catalog.vertical_dir, f) for f, _ in picto_catalog.get_vertical_pictos()]
+        for category in picto_catalog.get_categories():
+            paths += [
+                os.path.join(picto_catalog.horizontal_dir, category, f)
+                for f, _ in picto_catalog.get_horizontal_pictos(category)
+            ]
+        return paths
+
+    def get_signature(self, paths=None):
+        data_dir = os.path.dirname(picto_catalog.vertical_dir)
+        files = []
+        for path in paths or self._get_picto_paths():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((os.path.relpath(path, data_dir), stat.st_mtime_ns, stat.st_size))
+        data = json.dumps({'sizes': get_atlas_sizes(), 'files': files})
+        return hashlib.sha256(data.encode()).hexdigest()[:16]
+
+    def get(self, picto_path, max_size, decode):
+        """The picto cropped from the atlas, or None if it is not (or not yet) in there
+
+        `decode(picto_path, max_size)` is what the atlas is built with, and what a
+        rebuild started from here uses.
+        """
+        if not self.is_enabled():
+            return None
+
+        check_interval = getattr(settings, 'PICTO_CATALOG_CHECK_INTERVAL', 5)
+        now = time.monotonic()
+        with self._lock:
+            if now - self._checked_at >= check_interval:
+                self._checked_at = now
+                try:
+                    self._refresh(decode)
+                except (OSError, ValueError) as e:
+                    # e.g. a rebuild removed the file of the index just read: decode
+                    # until the next check maps the new atlas
+                    logger.warning('Could not map the picto atlas', extra={'error': str(e)})
+                    self._index = self._image = None
+            if self._index is None:
+                return None
+            box = self._index['pictos'].get(f'{os.path.normpath(picto_path)}:{max_size}')
+            if box is None:
+                return None
+            x, y, width, height = box
+            return self._image.crop((x, y, x + width, y + height))
+
+    def _refresh(self, decode):
+        """Map the current atlas, or rebuild it in the background if Data/ changed"""
+        signature = self.get_signature()
+        if self._index is not None and self._index['signature'] == signature:
+            return
+
+        index = self._load_index()
+        if index is not None and index['signature'] == signature:
+            self._map(index)
+            return
+
+        # Stale: decode as usual until the rebuilt atlas is there
+        self._index = self._image = None
+        if not self._rebuilding:
+            self._rebuilding = True
+            threading.Thread(target=self._rebuild_in_background, args=(decode,), daemon=True).start()
+
+    def _rebuild_in_background(self, decode):
+        try:
+            self.build(decode)
+        except Exception as e:
+            logger.warning('Could not build the picto atlas', extra={'error': str(e)})
+        finally:
+            with self._lock:
+                self._rebuilding = False
+                # Pick the new atlas up on the next call
+                self._checked_at = 0
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(get_atlas_dir(), 'picto_atlas.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _map(self, index):
+        with open(os.path.join(get_atlas_dir(), index['file']), 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        image = Image.frombuffer('RGBA', (index['width'], index['height']), mapping, 'raw', 'RGBA', 0, 1)
+
+        data_dir = os.path.dirname(picto_catalog.vertical_dir)
+        self._image = image
+        self._index = {
+            'signature': index['signature'],
+            'pictos': {
+                f'{os.path.normpath(os.path.join(data_dir, relpath))}:{size}': box
+                for relpath, boxes in index['pictos'].items()
+                for size, box in boxes.items()
+            },
+        }
+        logger.info('Mapped picto atlas', extra={'file': index['file'], 'pictos': len(index['pictos'])})
+
+    def build(self, decode, force=False):
+        """Write the atlas of the current Data/ tree; returns its index, or None if another
+        process is already building it
+        """
+        atlas_dir = get_atlas_dir()
+        os.makedirs(atlas_dir, exist_ok=True)
+
+        with open(os.path.join(atlas_dir, 'picto_atlas.lock'), 'w') as lock_file:
+            try:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+
+            paths = self._get_picto_paths()
+            signature = self.get_signature(paths)
+            index = self._load_index()
+            if not force and index is not None and index['signature'] == signature:
+                return index
+
+            data_dir = os.path.dirname(picto_catalog.vertical_dir)
+            pictos = {}
+            placed = []
+            x = y = row_height = 0
+            # Shelf packing, largest size first: a row is as tall as its tallest picto and
+            # the remainder of a row is filled with the pictos of the next size
+            for size in reversed(get_atlas_sizes()):
+                for path in paths:
+                    try:
+                        picto = decode(path, size)
+                    except Exception as e:
+                        logger.warning('Skipping picto', extra={'path': path, 'error': str(e)})
+                        continue
+                    if x + picto.width > ATLAS_WIDTH:
+                        x, y, row_height = 0, y + row_height, 0
+                    placed.append((picto, x, y))
+                    pictos.setdefault(os.path.relpath(path, data_dir), {})[str(size)] = [x, y, picto.width, picto.height]
+                    x += picto.width
+                    row_height = max(row_height, picto.height)
+
+            atlas = Image.new('RGBA', (ATLAS_WIDTH, max(1, y + row_height)), (0, 0, 0, 0))
+            for picto, picto_x, picto_y in placed:
+                atlas.paste(picto, (picto_x, picto_y))
+
+            # Readers keep their mapping of the previous file until they remap
+            file_name = f'picto_atlas-{signature}.rgba'
+            file_path = os.path.join(atlas_dir, file_name)
+            with open(f'{file_path}.tmp', 'wb') as f:
+                f.write(atlas.tobytes())
+            os.replace(f'{file_path}.tmp', file_path)
+
+            index = {
+                'signature': signature,
+                'file': file_name,
+                'width': atlas.width,
+                'height': atlas.height,
+                'pictos': pictos,
+            }
+            index_path = os.path.join(atlas_dir, 'picto_atlas.json')
+            with open(f'{index_path}.tmp', 'w') as f:
+                json.dump(index, f)
+            os.replace(f'{index_path}.tmp', index_path)
+
+            for name in os.listdir(atlas_dir):
+                if name.startswith('picto_atlas-') and name != file_name:
+                    os.remove(os.path.join(atlas_dir, name))
+
+            logger.info('Built picto atlas', extra={'file': file_name, 'pictos': len(pictos)})
+            return index
+
+
+picto_atlas = PictoAtlas()
@@ -0,0 +1,144 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from PIL import Image
+from .metrics import process_metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundCache:
+    """Process-wide cache of the background layer, already at canvas size and in RGBA.
+
+    Each gunicorn worker decodes the background once; renders get a cheap copy.
+    Entries are revalidated against the file mtime so a replaced background is
+    picked up without restarting the workers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (width, height) -> (path, mtime_ns, RGBA image)
+        self._entries = {}
+
+    def get(self, possible_paths, size):
+        """Return a copy of the normalized background for `size`, or None if no candidate loads"""
+        for path in possible_paths:
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+
+            with self._lock:
+                entry = self._entries.get(size)
+            if entry and entry[0] == path and entry[1] == mtime:
+                return entry[2].copy()
+
+            try:
+                background = self._load(path, size)
+            except Exception as e:
+                logger.warning('Error loading background', extra={'path': path, 'error': str(e)})
+                continue
+
+            with self._lock:
+                self._entries[size] = (path, mtime, background)
+            logger.info('Loaded background', extra={'path': path})
+            return background.copy()
+
+        return None
+
+    def version(self, possible_paths):
+        """Identify the background a render would use by its path and mtime"""
+        for path in possible_paths:
+            try:
+                return f'{path}:{os.stat(path).st_mtime_ns}'
+            except OSError:
+                continue
+        return 'none'
+
+    def _load(self, path, size):
+        with Image.open(path) as image:
+            if image.size != size:
+                image = image.resize(size, Image.Resampling.LANCZOS)
+            return image.convert('RGBA')
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class PictoCache:
+    """Bounded LRU store of decoded, resized pictos keyed by (path, max_size, mtime).
+
+    A batch applies the same handful of pictos to every product, so each picto
+    should be decoded and resized once per worker rather than once per render.
+    Cached images are shared between renders and must not be modified in place.
+    """
+
+    def __init__(self, max_bytes=None):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def max_bytes(self):
+        if self._max_bytes is None:
+            return getattr(settings, 'PICTO_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+        return self._max_bytes
+
+    def get(self, picto_path, max_size, loader):
+        """Return the cached picto, calling `loader(picto_path, max_size)` on a miss"""
+        mtime = os.stat(picto_path).st_mtime_ns
+        key = (picto_path, max_size, mtime)
+
+        with self._lock:
+            picto = self._entries.get(key)
+            if picto is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                process_metrics.inc('picto_cache_hits_total')
+                return picto
+            self.misses += 1
+            process_metrics.inc('picto_cache_misses_total')
+
+        picto = loader(picto_path, max_size)
+        size = picto.width * picto.height * len(picto.getbands())
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = picto
+                self.current_bytes += size
+                self._evict()
+        return picto
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and len(self._entries) > 1:
+            _, old = self._entries.popitem(last=False)
+            self.current_bytes -= old.width * old.height * len(old.getbands())
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+
+background_cache = BackgroundCache()
+picto_cache = PictoCache()
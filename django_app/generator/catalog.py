@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from urllib.parse import quote
+from django.conf import settings
+
+
+PICTO_EXTENSIONS = ('.webp', '.png', '.jpg', '.jpeg')
+
+
+def get_picto_label(filename):
+    """Display name of a picto file: name without extension, separators as spaces"""
+    return os.path.splitext(filename)[0].replace('_', ' ').replace('-', ' ')
+
+
+class PictoCatalog:
+    """In-memory index of the picto folders (categories, files and display labels)
+
+    Built once per process and rebuilt only when the mtime of one of the picto
+    directories changes, i.e. when a file or category is added, removed or renamed.
+    Directory mtimes are checked at most every PICTO_CATALOG_CHECK_INTERVAL seconds.
+    """
+
+    def __init__(self, data_dir):
+        self.vertical_dir = os.path.join(data_dir, 'Vertical_pictos')
+        self.horizontal_dir = os.path.join(data_dir, 'horizantal_Pictos')
+        self._lock = threading.Lock()
+        self._index = None
+        self._signature = None
+        self._checked_at = 0
+
+    @property
+    def index(self):
+        check_interval = getattr(settings, 'PICTO_CATALOG_CHECK_INTERVAL', 5)
+        now = time.monotonic()
+
+        with self._lock:
+            if self._index is None or now - self._checked_at >= check_interval:
+                signature = self._get_signature()
+                if signature != self._signature:
+                    self._index = self._build()
+                    # Watch the category folders of the new index as well
+                    self._signature = self._get_signature()
+                self._checked_at = now
+            return self._index
+
+    def _get_signature(self):
+        directories = [self.vertical_dir, self.horizontal_dir]
+        if self._index is not None:
+            directories += [os.path.join(self.horizontal_dir, category) for category in self._index['categories']]
+
+        signature = []
+        for directory in directories:
+            try:
+                signature.append((directory, os.stat(directory).st_mtime_ns))
+            except OSError:
+                signature.append((directory, None))
+        return tuple(signature)
+
+    def _list_pictos(self, directory):
+        return sorted(f for f in os.listdir(directory) if f.endswith(PICTO_EXTENSIONS))
+
+    def _build(self):
+        vertical = []
+        if os.path.exists(self.vertical_dir):
+            vertical = [(f, get_picto_label(f).title()) for f in self._list_pictos(self.vertical_dir)]
+
+        categories = []
+        horizontal = {}
+        if os.path.exists(self.horizontal_dir):
+            categories = sorted(
+                d for d in os.listdir(self.horizontal_dir)
+                if os.path.isdir(os.path.join(self.horizontal_dir, d))
+            )
+            for category in categories:
+                files = self._list_pictos(os.path.join(self.horizontal_dir, category))
+                horizontal[category] = tuple((f, get_picto_label(f)) for f in files)
+
+        index = {
+            'vertical': tuple(vertical),
+            'categories': tuple(categories),
+            'horizontal': horizontal,
+            'horizontal_sets': {category: frozenset(f for f, _ in files) for category, files in horizontal.items()},
+        }
+        index['json'] = self._serialize(index)
+        index['etag'] = hashlib.sha256(index['json']).hexdigest()[:32]
+        return index
+
+    def _serialize(self, index):
+        """Whole catalog as JSON, with the URL each picto is served from"""
+        def entries(files, url_prefix):
+            return [{'value': f, 'label': label, 'url': url_prefix + quote(f)} for f, label in files]
+
+        return json.dumps({
+            'vertical': entries(index['vertical'], '/data/Vertical_pictos/'),
+            'horizontal': {
+                category: entries(index['horizontal'][category], f'/data/horizantal_Pictos/{quote(category)}/')
+                for category in index['categories']
+            },
+        }).encode()
+
+    def get_vertical_pictos(self):
+        """(filename, label) of every vertical picto"""
+        return self.index['vertical']
+
+    def get_categories(self):
+        return self.index['categories']
+
+    def get_horizontal_pictos(self, category):
+        """(filename, label) of every horizontal picto in a category"""
+        return self.index['horizontal'].get(category, ())
+
+    def has_horizontal_picto(self, category, filename):
+        return filename in self.index['horizontal_sets'].get(category, ())
+
+    def get_json(self):
+        """(JSON body, ETag) of the whole catalog, serialized once per rebuild"""
+        index = self.index
+        return index['json'], index['etag']
+
+
+picto_catalog = PictoCatalog(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'Data'))
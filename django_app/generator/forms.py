@@ -1,45 +1,18 @@
-import os
 from django import forms
 from .models import BatchSubmission
+from .catalog import picto_catalog
 
 def get_vertical_picto_choices():
-    """Dynamically scan Vertical_pictos folder and return choices"""
-    choices = [('', '-- None --')]
-    base_dir = os.path.dirname(os.path.dirname(__file__))
-    vertical_dir = os.path.join(base_dir, 'Data', 'Vertical_pictos')
-    
-    if os.path.exists(vertical_dir):
-        files = sorted([f for f in os.listdir(vertical_dir) if f.endswith(('.webp', '.png', '.jpg', '.jpeg'))])
-        for f in files:
-            # Use filename without extension as display name
-            display_name = os.path.splitext(f)[0].replace('_', ' ').replace('-', ' ').title()
-            choices.append((f, display_name))
-    
-    return choices
+    """Vertical picto choices from the picto catalog"""
+    return [('', '-- None --')] + list(picto_catalog.get_vertical_pictos())
 
 def get_horizontal_category_choices():
-    """Dynamically scan horizantal_Pictos folder for category subfolders"""
-    choices = [('', '-- None --')]
-    base_dir = os.path.dirname(os.path.dirname(__file__))
-    horizontal_dir = os.path.join(base_dir, 'Data', 'horizantal_Pictos')
-    
-    if os.path.exists(horizontal_dir):
-        categories = sorted([d for d in os.listdir(horizontal_dir) if os.path.isdir(os.path.join(horizontal_dir, d))])
-        for cat in categories:
-            choices.append((cat, cat))
-    
-    return choices
+    """Horizontal category choices from the picto catalog"""
+    return [('', '-- None --')] + [(cat, cat) for cat in picto_catalog.get_categories()]
 
 def get_horizontal_files_for_category(category):
     """Get files for a specific horizontal category"""
-    files = []
-    base_dir = os.path.dirname(os.path.dirname(__file__))
-    cat_dir = os.path.join(base_dir, 'Data', 'horizantal_Pictos', category)
-    
-    if os.path.exists(cat_dir):
-        files = sorted([f for f in os.listdir(cat_dir) if f.endswith(('.webp', '.png', '.jpg', '.jpeg'))])
-    
-    return files
+    return [f for f, _ in picto_catalog.get_horizontal_pictos(category)]
 
 
 class MultipleFileInput(forms.ClearableFileInput):
@@ -115,8 +88,7 @@ class ProductSubmissionForm(forms.Form):
             file = cleaned_data.get(f'horizontal_file_{i}')
             
             if cat and file:
-                valid_files = get_horizontal_files_for_category(cat)
-                if file not in valid_files:
+                if not picto_catalog.has_horizontal_picto(cat, file):
                     self.add_error(f'horizontal_file_{i}', f'Invalid file for category {cat}')
         
         return cleaned_data
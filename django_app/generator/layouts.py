@@ -0,0 +1,137 @@
+import json
+import os
+import threading
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+# Selections a batch holds per side (BatchSubmission.vertical_pos_1..5, horizontal_*_1..5)
+MAX_SLOTS = 5
+
+# The original 800x800 render, used when icon_config.json defines no "default" layout
+DEFAULT_LAYOUT = {
+    'canvas': [800, 800],
+    'product_box': 350,
+    'guide_box': 450,
+    'picto_size': 130,
+    # Position 1 (bottom) to 5 (top), 145 px apart: 130 px pictos with a 15 px gap
+    'vertical': [[20, 575], [20, 430], [20, 285], [20, 140], [20, 5]],
+    'horizontal': [[680, 575], [680, 430], [680, 285], [680, 140], [680, 5]],
+}
+
+_plans = {}
+_lock = threading.Lock()
+
+
+def get_config_path():
+    return getattr(settings, 'LAYOUT_CONFIG', None) or os.path.join(
+        os.path.dirname(os.path.dirname(__file__)), 'icon_config.json'
+    )
+
+
+def load_layouts():
+    """Layout definitions by name: the "layouts" of icon_config.json over the default one"""
+    layouts = {'default': DEFAULT_LAYOUT}
+    try:
+        with open(get_config_path()) as f:
+            layouts.update(json.load(f).get('layouts', {}))
+    except FileNotFoundError:
+        pass
+    except ValueError as e:
+        raise ImproperlyConfigured(f'Invalid {get_config_path()}: {e}')
+    return layouts
+
+
+class RenderPlan:
+    """A layout compiled once for the renderer and the preview editor
+
+    `vertical_slots` and `horizontal_slots` are the (x, y, picto size) of each position
+    (1 = bottom), `product_box` the (left, top, right, bottom) box products are centered
+    and fitted in. The editor gets the same geometry through get_editor_data().
+    """
+
+    def __init__(self, name, layout):
+        self.name = name
+        try:
+            self.width, self.height = (int(value) for value in layout['canvas'])
+            self.product_size = int(layout['product_box'])
+            self.picto_size = int(layout.get('picto_size', 130))
+            self.guide_size = int(layout.get('guide_box', self.product_size))
+            self.vertical_slots = self._compile_slots(layout.get('vertical', []))
+            self.horizontal_slots = self._compile_slots(layout.get('horizontal', []))
+        except (KeyError, TypeError, ValueError) as e:
+            raise ImproperlyConfigured(f'Invalid layout {name!r}: {e}')
+
+        if not 0 < self.product_size <= min(self.width, self.height):
+            raise ImproperlyConfigured(f'Invalid layout {name!r}: the product box does not fit the canvas')
+
+        left = (self.width - self.product_size) // 2
+        top = (self.height - self.product_size) // 2
+        self.product_box = (left, top, left + self.product_size, top + self.product_size)
+        self.picto_sizes = sorted({size for _, _, size in self.vertical_slots + self.horizontal_slots})
+        # Everything here that changes the rendered pixels (part of the render cache key)
+        self.signature = {
+            'canvas': [self.width, self.height],
+            'product_box': self.product_size,
+            'vertical': self.vertical_slots,
+            'horizontal': self.horizontal_slots,
+        }
+
+    def _compile_slots(self, slots):
+        """[x, y] or [x, y, size] entries as (x, y, size) tuples, checked against the canvas"""
+        if len(slots) > MAX_SLOTS:
+            raise ValueError(f'at most {MAX_SLOTS} slots per side')
+        compiled = []
+        for slot in slots:
+            x_pos, y_pos, size = (*(int(value) for value in slot), self.picto_size)[:3]
+            if not (0 <= x_pos < self.width and 0 <= y_pos < self.height and size > 0):
+                raise ValueError(f'slot {list(slot)} is outside the canvas')
+            compiled.append((x_pos, y_pos, size))
+        return compiled
+
+    def get_pictos(self, vertical_dir, horizontal_dir, vertical_selections, horizontal_selections):
+        """(path, x, y, size) of the selected pictos in their slots, for create_layout_overlay()
+        Only renders explicitly selected pictos - no automatic additions
+        """
+        pictos = []
+        for (x_pos, y_pos, size), filename in zip(self.vertical_slots, vertical_selections):
+            if filename and filename.strip():
+                pictos.append((os.path.join(vertical_dir, filename.strip()), x_pos, y_pos, size))
+        for (x_pos, y_pos, size), (category, filename) in zip(self.horizontal_slots, horizontal_selections):
+            if category and filename:
+                pictos.append((os.path.join(horizontal_dir, category, filename), x_pos, y_pos, size))
+        return pictos
+
+    def get_editor_data(self, vertical_selections, horizontal_selections):
+        """Canvas geometry and picto placements of the preview editor, for the same selections"""
+        vertical = [
+            {'url': f'/data/Vertical_pictos/{filename.strip()}', 'x': x_pos, 'y': y_pos, 'size': size}
+            for (x_pos, y_pos, size), filename in zip(self.vertical_slots, vertical_selections)
+            if filename and filename.strip()
+        ]
+        horizontal = [
+            {'url': f'/data/horizantal_Pictos/{category}/{filename}', 'x': x_pos, 'y': y_pos, 'size': size}
+            for (x_pos, y_pos, size), (category, filename) in zip(self.horizontal_slots, horizontal_selections)
+            if category and filename
+        ]
+        return {
+            'layout': self.name,
+            'canvas': {'width': self.width, 'height': self.height},
+            'product_size': self.product_size,
+            'guide_size': self.guide_size,
+            'picto_size': self.picto_size,
+            'vertical': vertical,
+            'horizontal': horizontal,
+        }
+
+
+def get_render_plan(name=None):
+    """Compiled plan of layout `name` (default: RENDER_LAYOUT), built once per process"""
+    name = name or getattr(settings, 'RENDER_LAYOUT', 'default')
+    with _lock:
+        if name not in _plans:
+            layouts = load_layouts()
+            if name not in layouts:
+                raise ImproperlyConfigured(f'Unknown layout {name!r}, expected one of {", ".join(sorted(layouts))}')
+            _plans[name] = RenderPlan(name, layouts[name])
+        return _plans[name]
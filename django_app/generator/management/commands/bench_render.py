@@ -0,0 +1,421 @@
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from io import BytesIO, StringIO
+
+import PIL
+from PIL import Image, ImageChops, ImageDraw
+from django.conf import settings
+from django.core.files.storage import storages
+from django.core.files.uploadhandler import load_handler
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.http.multipartparser import MultiPartParser
+
+from generator.catalog import picto_catalog
+from generator.forms import ProductSubmissionForm
+from generator.management.commands import render_worker
+from generator.models import THUMBNAIL_FIELDS, RenderJob
+from generator.pool import get_pool_pids
+from generator.storage import ResultFileSystemStorage
+from generator.views import ProductIconGenerator, render_upload, store_upload
+
+
+STAGES = ['decode', 'resize', 'overlay', 'composite', 'flatten', 'encode', 'thumbnails', 'upload']
+
+# Synthetic product formats: name -> (Pillow mode of the source, file format)
+MODES = {
+    'jpeg': ('RGB', 'JPEG'),
+    'png_rgba': ('RGBA', 'PNG'),
+    'png_palette': ('P', 'PNG'),
+}
+
+
+def make_product_image(mode, size):
+    """Encode a synthetic product photo: a textured bottle shape on a plain or transparent background"""
+    width, height = size
+    # Noise keeps the encoded size and the decode cost close to real photos; seeded, so
+    # that the renders of two runs can be compared (see compare_renders)
+    noise = random.Random(width * height).randbytes(width * height)
+    texture = Image.merge('RGB', [
+        Image.linear_gradient('L').resize(size),
+        Image.frombytes('L', size, noise).point(lambda v: v // 4 + 92),
+        Image.radial_gradient('L').resize(size),
+    ])
+    shape = Image.new('L', size, 0)
+    ImageDraw.Draw(shape).rounded_rectangle(
+        (width // 4, height // 10, width * 3 // 4, height * 9 // 10), radius=width // 10, fill=255
+    )
+
+    source_mode, file_format = MODES[mode]
+    if source_mode == 'RGBA':
+        image = texture.convert('RGBA')
+        image.putalpha(shape)
+    else:
+        image = Image.new('RGB', size, (255, 255, 255))
+        image.paste(texture, (0, 0), shape)
+        if source_mode == 'P':
+            image = image.quantize(256)
+
+    data = BytesIO()
+    image.save(data, file_format, **({'quality': 90} if file_format == 'JPEG' else {}))
+    return data.getvalue()
+
+
+def get_renders_dir(results_path):
+    """Directory of the renders saved with a results file: baseline.json -> baseline-renders/"""
+    return f'{os.path.splitext(results_path)[0]}-renders'
+
+
+def get_picto_selections(count):
+    """Vertical then horizontal picto selections filling `count` of the 10 slots"""
+    vertical = [f for f, _ in picto_catalog.get_vertical_pictos()[:min(count, 5)]]
+    horizontal = []
+    for category in picto_catalog.get_categories():
+        for filename, _ in picto_catalog.get_horizontal_pictos(category):
+            if len(horizontal) < count - len(vertical):
+                horizontal.append((category, filename))
+    if len(vertical) + len(horizontal) < count:
+        raise CommandError(f'Not enough pictos in Data/ for {count} slots')
+    return vertical + [''] * (5 - len(vertical)), horizontal + [('', '')] * (5 - len(horizontal))
+
+
+def get_peak_rss_mb():
+    """Peak resident memory of this process so far"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def get_pool_peak_rss_mb():
+    """Sum of the peak resident memory of the render pool processes (Linux only, else 0)"""
+    peak = 0
+    for pid in get_pool_pids():
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        peak += int(line.split()[1])
+        except OSError:
+            pass
+    return round(peak / 1024, 1)
+
+
+class Command(BaseCommand):
+    help = 'Benchmark ProductIconGenerator.process_product on synthetic products and compare with a baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='600,2000,4000',
+                            help='Comma-separated long sides of the synthetic products (default: 600,2000,4000)')
+        parser.add_argument('--modes', default=','.join(MODES),
+                            help=f'Comma-separated product formats among {", ".join(MODES)} (default: all)')
+        parser.add_argument('--pictos', default='0,5,10',
+                            help='Comma-separated picto counts (default: 0,5,10)')
+        parser.add_argument('--iterations', type=int, default=5,
+                            help='Timed renders per scenario, after one warm-up render (default: 5)')
+        parser.add_argument('--output', help='Write the results to this JSON file (use it as a baseline)')
+        parser.add_argument('--compare', help='Baseline JSON file to compare the results with')
+        parser.add_argument('--threshold', type=float, default=10.0,
+                            help='Percentage a median may exceed the baseline before it is a regression (default: 10)')
+        parser.add_argument('--min-delta-ms', type=float, default=0.5,
+                            help='Ignore slowdowns smaller than this many milliseconds (default: 0.5)')
+        parser.add_argument('--max-pixel-delta', type=int, default=2,
+                            help='Largest per-pixel difference from the renders of the --compare baseline '
+                                 '(saved next to its JSON file) that is not a regression (default: 2)')
+        parser.add_argument('--memory-check', metavar='BATCH_SIZES',
+                            help='Instead of the benchmark, upload and render batches of these comma-separated '
+                                 'sizes (e.g. 10,50,200) of the largest --sizes product the way the upload form '
+                                 'does, and fail if the peak memory grows with the batch size. Uses the '
+                                 'configured database and storage; batches are rolled back and their files deleted')
+        parser.add_argument('--render-mode', choices=['sync', 'parallel', 'queue'],
+                            help='RENDER_MODE of the --memory-check uploads (default: the configured one)')
+        parser.add_argument('--max-rss-growth', type=float, default=25.0,
+                            help='MB the peak memory may grow from the smallest to the largest batch (default: 25)')
+        parser.add_argument('--storage', choices=['temp', 'default'], default='temp',
+                            help='Save the results to a temporary directory, or to the configured storage '
+                                 '(e.g. a test bucket of an S3-compatible service) to time the uploads (default: temp)')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        modes = options['modes'].split(',')
+        picto_counts = [int(count) for count in options['pictos'].split(',')]
+        unknown_modes = set(modes) - set(MODES)
+        if unknown_modes:
+            raise CommandError(f'Unknown modes: {", ".join(sorted(unknown_modes))}')
+        if options['iterations'] < 1:
+            raise CommandError('--iterations must be at least 1')
+
+        # Synthetic renders stay out of the host's /metrics totals (render pool processes
+        # get their settings from the environment)
+        os.environ['METRICS_ENABLED'] = 'False'
+        settings.METRICS_ENABLED = False
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            self.storage = (
+                ResultFileSystemStorage(location=work_dir) if options['storage'] == 'temp' else storages['results']
+            )
+            return self.run(options, sizes, modes, picto_counts)
+
+    def run(self, options, sizes, modes, picto_counts):
+        if options['memory_check']:
+            batch_sizes = sorted(int(size) for size in options['memory_check'].split(','))
+            render_mode = options['render_mode'] or settings.RENDER_MODE
+            return self.check_memory(batch_sizes, max(sizes), modes[0], render_mode, options['max_rss_growth'])
+
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+
+        results = {
+            'meta': {
+                'python': platform.python_version(),
+                'pillow': PIL.__version__,
+                'machine': platform.machine(),
+                'cpu_count': os.cpu_count(),
+                'iterations': options['iterations'],
+            },
+            'scenarios': {},
+        }
+
+        # The final pixels of each scenario are saved next to the results, and compared with
+        # those saved next to the baseline
+        if options['output']:
+            os.makedirs(get_renders_dir(options['output']), exist_ok=True)
+        baseline_renders_dir = get_renders_dir(options['compare']) if baseline is not None else None
+        if baseline_renders_dir and not os.path.isdir(baseline_renders_dir):
+            self.stdout.write(f'No baseline renders in {baseline_renders_dir}, pixels are not compared')
+            baseline_renders_dir = None
+        pixel_regressions = []
+
+        # Smallest first, so the peak memory of a scenario is not hidden by an earlier one
+        for size in sorted(sizes):
+            for mode in modes:
+                product = make_product_image(mode, (size, size * 3 // 4))
+                for picto_count in picto_counts:
+                    name = f'{mode}-{size}-{picto_count}p'
+                    scenario, render = self.run_scenario(product, picto_count, options['iterations'])
+                    results['scenarios'][name] = scenario
+                    self.stdout.write(self.format_scenario(name, scenario))
+
+                    if options['output']:
+                        render.save(os.path.join(get_renders_dir(options['output']), f'{name}.png'))
+                    if baseline_renders_dir and not self.compare_render(
+                            baseline_renders_dir, name, render, options['max_pixel_delta']):
+                        pixel_regressions.append((name, 'pixels'))
+                    render.close()
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(f'Results written to {options["output"]}, renders to {get_renders_dir(options["output"])}')
+
+        if baseline is not None:
+            regressions = self.compare(baseline, results, options['threshold'], options['min_delta_ms'])
+            regressions += pixel_regressions
+            if regressions:
+                raise CommandError(f'{len(regressions)} regression(s) beyond {options["threshold"]}% '
+                                   f'or {options["max_pixel_delta"]} per pixel')
+            self.stdout.write(self.style.SUCCESS('No regressions'))
+
+    def run_scenario(self, product, picto_count, iterations):
+        """Render one synthetic product `iterations` times
+        Returns the medians per stage in milliseconds and the final RGB image
+        """
+        generator = ProductIconGenerator()
+        generator.storage = self.storage
+        vertical_selections, horizontal_selections = get_picto_selections(picto_count)
+
+        # As in a batch, the picto overlay is built once and shared by every product
+        started = time.perf_counter()
+        overlay = generator.create_overlay(vertical_selections, horizontal_selections)
+        overlay_ms = (time.perf_counter() - started) * 1000
+
+        # Warm-up: fills the background and picto caches
+        generator.process_product(BytesIO(product), vertical_selections, horizontal_selections,
+                                  overlay=overlay, output_name='bench')
+        # The pixels before encoding, for compare_renders()
+        render = generator.compose(generator.decode_product(BytesIO(product)), overlay)
+
+        stage_times = {stage: [] for stage in STAGES}
+        totals = []
+        for _ in range(iterations):
+            started = time.perf_counter()
+            result_path = generator.process_product(BytesIO(product), vertical_selections, horizontal_selections,
+                                                    overlay=overlay, output_name='bench')
+            totals.append(time.perf_counter() - started)
+            if result_path is None:
+                raise CommandError('Rendering failed')
+            for stage in STAGES:
+                stage_times[stage].append(generator.stage_times.get(stage, 0))
+
+        stages = {stage: round(statistics.median(times) * 1000, 2) for stage, times in stage_times.items()}
+        stages['overlay'] = round(overlay_ms, 2)
+        return {
+            'stages_ms': stages,
+            'total_ms': round(statistics.median(totals) * 1000, 2),
+            'images_per_sec': round(len(totals) / sum(totals), 2),
+            'peak_rss_mb': get_peak_rss_mb(),
+        }, render
+
+    def check_memory(self, batch_sizes, size, mode, render_mode, max_rss_growth):
+        """Upload and render batches of growing size like the upload form; the peak memory must not follow
+        The batches go through the same store_upload() / render_upload() dispatch as the home
+        view in `render_mode` ('queue' jobs are run by a render worker in this process). The
+        peak is this process's plus that of the render pool processes.
+        """
+        settings.RENDER_MODE = render_mode
+        # The copies of the product would be render cache hits: render every one of them
+        settings.RENDER_CACHE_ENABLED = False
+        product = make_product_image(mode, (size, size * 3 // 4))
+        vertical_selections, horizontal_selections = get_picto_selections(5)
+        fields = {f'vertical_pos_{i}': filename for i, filename in enumerate(vertical_selections, 1)}
+        for i, (category, filename) in enumerate(horizontal_selections, 1):
+            fields[f'horizontal_cat_{i}'] = category
+            fields[f'horizontal_file_{i}'] = filename
+
+        peaks = []
+        # Smallest first: peak memory only grows, so each batch can only raise the peak
+        for batch_size in batch_sizes:
+            started = time.perf_counter()
+            succeeded = self.upload_and_render(self.upload_batch(product, batch_size, fields))
+            if succeeded < batch_size:
+                raise CommandError(f'Rendering failed for {batch_size - succeeded} of {batch_size} products')
+            peaks.append(get_peak_rss_mb() + get_pool_peak_rss_mb())
+            self.stdout.write(f'{batch_size:5d} x {mode}-{size}  {render_mode:8s} '
+                              f'{time.perf_counter() - started:7.1f} s  peak rss {peaks[-1]:7.1f} MB')
+
+        growth = peaks[-1] - peaks[0]
+        if growth > max_rss_growth:
+            raise CommandError(f'Peak memory grew by {growth:.1f} MB from {batch_sizes[0]} to {batch_sizes[-1]} '
+                               f'products (limit {max_rss_growth} MB)')
+        self.stdout.write(self.style.SUCCESS(f'Peak memory grew by {growth:.1f} MB'))
+
+    def upload_and_render(self, form):
+        """Store and render an upload like the home view; returns how many products succeeded
+        Nothing is kept: the database writes are rolled back and the stored files deleted
+        """
+        product_files = form.cleaned_data['product_images']
+        stored = []
+        try:
+            with transaction.atomic():
+                batch, submissions = store_upload(form, product_files)
+                stored = [('default', submission.product_image.name) for submission in submissions]
+
+                if settings.RENDER_MODE == 'queue':
+                    worker = render_worker.Command(stdout=StringIO())
+                    worker.start(worker_name='bench_render')
+                    for job in RenderJob.objects.filter(submission__batch=batch).select_related('submission__batch'):
+                        worker.run_job(job)
+                    submissions = list(batch.products.all())
+                else:
+                    render_upload(batch, submissions, product_files)
+
+                for submission in submissions:
+                    if submission.result_image:
+                        stored += [('results', getattr(submission, field).name)
+                                   for field in ['result_image', *THUMBNAIL_FIELDS]]
+                transaction.set_rollback(True)
+            return sum(1 for submission in submissions if submission.result_image)
+        finally:
+            for product_file in product_files:
+                product_file.close()
+            for alias, name in stored:
+                storages[alias].delete(name)
+
+    def upload_batch(self, product, count, fields):
+        """Parse and validate a product form upload of `count` copies of `product` and the picto
+        `fields`, with the configured upload handlers
+        """
+        boundary = 'bench-render-boundary'
+        # The body is spooled to disk so only the parser's memory use is measured
+        body = tempfile.TemporaryFile()
+        for name, value in fields.items():
+            body.write((
+                f'--{boundary}\r\n'
+                f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+                f'{value}\r\n'
+            ).encode())
+        for index in range(count):
+            body.write((
+                f'--{boundary}\r\n'
+                f'Content-Disposition: form-data; name="product_images"; filename="product_{index}"\r\n'
+                f'Content-Type: application/octet-stream\r\n\r\n'
+            ).encode())
+            body.write(product)
+            body.write(b'\r\n')
+        body.write(f'--{boundary}--\r\n'.encode())
+        meta = {
+            'CONTENT_TYPE': f'multipart/form-data; boundary={boundary}',
+            'CONTENT_LENGTH': str(body.tell()),
+        }
+        body.seek(0)
+
+        handlers = [load_handler(handler) for handler in settings.FILE_UPLOAD_HANDLERS]
+        with body:
+            post, files = MultiPartParser(meta, body, handlers).parse()
+        form = ProductSubmissionForm(post, files)
+        if not form.is_valid():
+            raise CommandError(f'Invalid upload: {form.errors.as_text()}')
+        return form
+
+    def compare_render(self, renders_dir, name, image, max_pixel_delta):
+        """Print how a render differs from the baseline's; returns False if a channel differs
+        by more than `max_pixel_delta` or the size changed
+        """
+        path = os.path.join(renders_dir, f'{name}.png')
+        if not os.path.exists(path):
+            return True
+        with Image.open(path) as previous:
+            previous = previous.convert('RGB')
+        if previous.size != image.size:
+            self.stdout.write(self.style.ERROR(f'{name} pixels: size {previous.size} -> {image.size}'))
+            return False
+
+        difference = ImageChops.difference(previous, image)
+        delta = max(high for _, high in difference.getextrema())
+        if not delta:
+            return True
+        # Pixels where any channel differs
+        red, green, blue = difference.split()
+        largest = ImageChops.lighter(ImageChops.lighter(red, green), blue)
+        pixels = image.width * image.height
+        differing = pixels - largest.histogram()[0]
+        style = self.style.ERROR if delta > max_pixel_delta else self.style.WARNING
+        self.stdout.write(style(
+            f'{name} pixels: max delta {delta}, {differing} pixel(s) ({differing / pixels:.2%}) differ'
+        ))
+        return delta <= max_pixel_delta
+
+    def format_scenario(self, name, scenario):
+        stages = ' '.join(f'{stage}={ms:.1f}' for stage, ms in scenario['stages_ms'].items())
+        return (f'{name:<24} {scenario["total_ms"]:8.1f} ms  {scenario["images_per_sec"]:6.1f} img/s  '
+                f'rss {scenario["peak_rss_mb"]:7.1f} MB  [{stages}]')
+
+    def compare(self, baseline, results, threshold, min_delta_ms):
+        """Print every median slower than the baseline by more than `threshold` percent"""
+        regressions = []
+        for name, scenario in results['scenarios'].items():
+            previous = baseline.get('scenarios', {}).get(name)
+            if previous is None:
+                self.stdout.write(f'{name}: not in baseline')
+                continue
+
+            metrics = [('total', previous['total_ms'], scenario['total_ms'])]
+            metrics += [
+                (stage, previous['stages_ms'].get(stage, 0), ms) for stage, ms in scenario['stages_ms'].items()
+            ]
+            for metric, before, after in metrics:
+                if after - before > min_delta_ms and after > before * (1 + threshold / 100):
+                    change = (after / before - 1) * 100 if before else float('inf')
+                    regressions.append((name, metric))
+                    self.stdout.write(self.style.ERROR(
+                        f'{name} {metric}: {before:.1f} ms -> {after:.1f} ms (+{change:.0f}%)'
+                    ))
+        return regressions
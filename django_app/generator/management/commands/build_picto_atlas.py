@@ -0,0 +1,26 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from generator.atlas import get_atlas_dir, get_atlas_sizes, picto_atlas
+from generator.views import ProductIconGenerator
+
+
+class Command(BaseCommand):
+    help = 'Pack every picto, pre-resized, into the memory-mapped picto atlas'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                            help='Rebuild even if the atlas matches the current Data/ tree')
+
+    def handle(self, *args, **options):
+        generator = ProductIconGenerator()
+        index = picto_atlas.build(generator._decode_picto, force=options['force'])
+        if index is None:
+            raise CommandError('Another process is building the atlas')
+
+        atlas_path = os.path.join(get_atlas_dir(), index['file'])
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(index["pictos"])} pictos at {", ".join(f"{size}px" for size in get_atlas_sizes())} in '
+            f'{atlas_path} ({index["width"]}x{index["height"]}, {os.path.getsize(atlas_path) / 1024 / 1024:.1f} MB)'
+        ))
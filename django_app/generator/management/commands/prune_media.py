@@ -0,0 +1,292 @@
+import os
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from generator.models import THUMBNAIL_FIELDS, BatchSubmission, ProductSubmission, RenderCacheEntry
+
+# Names per `__in` lookup: below the SQLite bound-parameter limit
+LOOKUP_CHUNK = 500
+
+
+class IoBudget:
+    """Paces filesystem operations to at most `ops_per_second` (0 = unlimited)"""
+
+    def __init__(self, ops_per_second):
+        self.interval = 1 / ops_per_second if ops_per_second > 0 else 0
+        self.next_at = time.monotonic()
+
+    def spend(self, ops=1):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        if self.next_at > now:
+            time.sleep(self.next_at - now)
+        self.next_at = max(self.next_at, now) + ops * self.interval
+
+
+def iter_files(directory):
+    """os.DirEntry of every regular file under `directory`, walked lazily"""
+    pending = [directory]
+    while pending:
+        try:
+            with os.scandir(pending.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        yield entry
+        except FileNotFoundError:
+            continue
+
+
+def iter_stored_files(storage, directory=''):
+    """(name, size, modification timestamp) of every file under `directory` of `storage`
+    (default: the whole storage)
+
+    Streamed from os.scandir for the filesystem and from the paginated object listing
+    for S3; Storage.listdir() would load a whole directory at once.
+    """
+    if isinstance(storage, FileSystemStorage):
+        for entry in iter_files(os.path.join(storage.location, directory)):
+            try:
+                stat = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            yield os.path.relpath(entry.path, storage.location).replace(os.sep, '/'), stat.st_size, stat.st_mtime
+    elif hasattr(storage, 'bucket'):
+        location = storage.location.strip('/')
+        prefix = '/'.join(part for part in [location, directory.strip('/')] if part)
+        prefix = f'{prefix}/' if prefix else ''
+        for item in storage.bucket.objects.filter(Prefix=prefix):
+            yield item.key[len(location) + 1 if location else 0:], item.size, item.last_modified.timestamp()
+    else:
+        raise CommandError(f'Cannot list the files of {type(storage).__name__}, use --skip-orphans')
+
+
+def iter_chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def get_thumbnail_source(name):
+    """Result image of a thumbnail path (see get_thumbnail_path), or None"""
+    directory, filename = os.path.split(name)
+    if os.path.basename(directory) != 'thumbs':
+        return None
+    base_name, extension = os.path.splitext(filename)
+    for size in THUMBNAIL_FIELDS.values():
+        if base_name.endswith(f'_{size}'):
+            return os.path.join(os.path.dirname(directory), base_name[:-len(f'_{size}')] + extension)
+    return None
+
+
+def get_referenced(names, exclude_submissions=None):
+    """The names among `names` still used by a submission or a render cache entry
+
+    Thumbnails are referenced as long as their result image is. Submissions in
+    `exclude_submissions` (a queryset being deleted) do not count.
+    """
+    sources = {name: get_thumbnail_source(name) for name in names}
+    lookup = list(set(names) | {source for source in sources.values() if source})
+
+    submissions = ProductSubmission.objects.all()
+    if exclude_submissions is not None:
+        submissions = submissions.exclude(id__in=exclude_submissions.values('id'))
+
+    used = set()
+    for chunk in iter_chunks(lookup, LOOKUP_CHUNK):
+        used.update(submissions.filter(product_image__in=chunk).values_list('product_image', flat=True))
+        used.update(submissions.filter(result_image__in=chunk).values_list('result_image', flat=True))
+        used.update(RenderCacheEntry.objects.filter(result_image__in=chunk).values_list('result_image', flat=True))
+    return {name for name, source in sources.items() if name in used or source in used}
+
+
+class Command(BaseCommand):
+    help = 'Delete expired batches, old uploads and orphaned files from the media storage'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=getattr(settings, 'BATCH_RETENTION_DAYS', 0),
+                            help='Delete batches (and their files) older than this many days; 0 keeps them '
+                                 '(default: BATCH_RETENTION_DAYS)')
+        parser.add_argument('--upload-days', type=int, default=getattr(settings, 'UPLOAD_RETENTION_DAYS', 0),
+                            help='Delete the uploaded product of rendered submissions older than this many days; '
+                                 '0 keeps them (default: UPLOAD_RETENTION_DAYS)')
+        parser.add_argument('--grace-hours', type=float, default=24,
+                            help='Never delete orphaned files modified in the last hours, e.g. an upload whose '
+                                 'row is not committed yet (default: 24)')
+        parser.add_argument('--chunk-size', type=int, default=100,
+                            help='Batches, submissions or files handled per transaction (default: 100)')
+        parser.add_argument('--io-budget', type=int, default=getattr(settings, 'MEDIA_GC_IO_BUDGET', 200),
+                            help='Maximum filesystem operations (file scans and deletions) per second; '
+                                 '0 is unlimited (default: MEDIA_GC_IO_BUDGET)')
+        parser.add_argument('--skip-orphans', action='store_true',
+                            help='Do not walk the media storage for orphaned files')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report what would be deleted without deleting anything')
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be at least 1')
+
+        self.dry_run = options['dry_run']
+        self.chunk_size = options['chunk_size']
+        self.budget = IoBudget(options['io_budget'])
+        if hasattr(os, 'nice'):
+            # Leave the CPU to the renders first
+            os.nice(10)
+
+        if options['days'] > 0:
+            self.expire_batches(timezone.now() - timedelta(days=options['days']))
+        if options['upload_days'] > 0:
+            self.expire_uploads(timezone.now() - timedelta(days=options['upload_days']))
+        if not options['skip_orphans']:
+            self.sweep_orphans(time.time() - options['grace_hours'] * 3600)
+
+    def report(self, message):
+        prefix = 'Would delete' if self.dry_run else 'Deleted'
+        self.stdout.write(self.style.SUCCESS(f'{prefix} {message}'))
+
+    def expire_batches(self, cutoff):
+        """Delete batches created before `cutoff` with their submissions, chunk by chunk"""
+        batches = submissions = files = size = 0
+
+        # Keyset walk on id: each chunk is one small indexed query, never the whole table
+        last_id = 0
+        while True:
+            batch_ids = list(
+                BatchSubmission.objects.filter(created_at__lt=cutoff, id__gt=last_id)
+                .order_by('id').values_list('id', flat=True)[:self.chunk_size]
+            )
+            if not batch_ids:
+                break
+            last_id = batch_ids[-1]
+
+            chunk = ProductSubmission.objects.filter(batch_id__in=batch_ids)
+            count, deleted_files, deleted_size = self.delete_submissions(
+                chunk, BatchSubmission.objects.filter(id__in=batch_ids)
+            )
+            batches += len(batch_ids)
+            submissions += count
+            files += deleted_files
+            size += deleted_size
+
+        # Submissions from before batches existed
+        last_id = 0
+        while True:
+            submission_ids = list(
+                ProductSubmission.objects.filter(batch__isnull=True, created_at__lt=cutoff, id__gt=last_id)
+                .order_by('id').values_list('id', flat=True)[:self.chunk_size]
+            )
+            if not submission_ids:
+                break
+            last_id = submission_ids[-1]
+
+            count, deleted_files, deleted_size = self.delete_submissions(
+                ProductSubmission.objects.filter(id__in=submission_ids)
+            )
+            submissions += count
+            files += deleted_files
+            size += deleted_size
+
+        self.report(f'{batches} batch(es) and {submissions} submission(s) created before {cutoff:%Y-%m-%d}: '
+                    f'{files} file(s), {size / 1024 / 1024:.1f} MB')
+
+    def delete_submissions(self, submissions, batches=None):
+        """Delete `submissions` (and `batches`) in one transaction, then their unused files"""
+        names = set()
+        count = 0
+        for row in submissions.values_list('product_image', 'result_image', *THUMBNAIL_FIELDS):
+            names.update(name for name in row if name)
+            count += 1
+
+        unreferenced = sorted(set(names) - get_referenced(names, exclude_submissions=submissions))
+        if not self.dry_run:
+            with transaction.atomic():
+                # Render jobs cascade
+                submissions.delete()
+                if batches is not None:
+                    batches.delete()
+
+        # Files go once the rows are committed: a failure leaves orphans for the sweep,
+        # never rows pointing at missing files
+        files, size = self.delete_files(unreferenced)
+        return count, files, size
+
+    def expire_uploads(self, cutoff):
+        """Drop the uploaded product of submissions rendered before `cutoff`, chunk by chunk"""
+        submissions = files = size = 0
+
+        last_id = 0
+        while True:
+            rows = list(
+                ProductSubmission.objects.filter(created_at__lt=cutoff, id__gt=last_id)
+                .exclude(product_image='').exclude(result_image='').exclude(result_image__isnull=True)
+                .order_by('id').values_list('id', 'product_image')[:self.chunk_size]
+            )
+            if not rows:
+                break
+            last_id = rows[-1][0]
+
+            chunk = ProductSubmission.objects.filter(id__in=[submission_id for submission_id, _ in rows])
+            names = {name for _, name in rows}
+            unreferenced = sorted(names - get_referenced(names, exclude_submissions=chunk))
+            if not self.dry_run:
+                with transaction.atomic():
+                    chunk.update(product_image='')
+            deleted_files, deleted_size = self.delete_files(unreferenced)
+            submissions += len(rows)
+            files += deleted_files
+            size += deleted_size
+
+        self.report(f'uploads of {submissions} rendered submission(s) created before {cutoff:%Y-%m-%d}: '
+                    f'{files} file(s), {size / 1024 / 1024:.1f} MB')
+
+    def sweep_orphans(self, modified_before):
+        """Delete stored files no row refers to, streaming the walk of the whole storage
+        Strays also pile up at its root (e.g. `result_*.jpg.old` from before `results/`)
+        """
+        scanned = files = size = 0
+
+        for entries in iter_chunks(iter_stored_files(default_storage), self.chunk_size):
+            self.budget.spend(len(entries))
+            scanned += len(entries)
+
+            candidates = {
+                name: file_size for name, file_size, modified in entries if modified < modified_before
+            }
+            for name in sorted(set(candidates) - get_referenced(candidates)):
+                if not self.dry_run:
+                    self.budget.spend()
+                    default_storage.delete(name)
+                files += 1
+                size += candidates[name]
+
+        self.report(f'{files} orphaned file(s) out of {scanned} scanned: {size / 1024 / 1024:.1f} MB')
+
+    def delete_files(self, names):
+        """Delete media files by name under the I/O budget; returns (count, bytes)"""
+        files = size = 0
+        for name in names:
+            self.budget.spend()
+            try:
+                file_size = default_storage.size(name)
+            except OSError:
+                continue
+            if not self.dry_run:
+                self.budget.spend()
+                default_storage.delete(name)
+            files += 1
+            size += file_size
+        return files, size
@@ -0,0 +1,154 @@
+import os
+import socket
+import time
+import traceback
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import F
+from django.utils import timezone
+
+from generator.models import RenderJob
+from generator.views import ProductIconGenerator, render_submission, render_submission_layout
+
+
+# Claims of a job before a stale one (its worker died, e.g. OOM-killed on that product)
+# is failed instead of requeued
+MAX_ATTEMPTS = 3
+
+
+class Command(BaseCommand):
+    help = 'Drain the render job queue filled by the upload form when RENDER_MODE=queue'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Exit as soon as the queue is empty instead of polling for new jobs')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to wait between polls of an empty queue (default: 1)')
+        parser.add_argument('--max-jobs', type=int, default=0,
+                            help='Exit after processing this many jobs (default: unlimited)')
+        parser.add_argument('--stale-after', type=int, default=600,
+                            help='Requeue running jobs older than this many seconds, e.g. after a worker crash (default: 600)')
+        parser.add_argument('--max-attempts', type=int, default=MAX_ATTEMPTS,
+                            help='Fail stale jobs already claimed this many times instead of requeuing them '
+                                 f'(default: {MAX_ATTEMPTS})')
+
+    def handle(self, *args, **options):
+        self.start()
+
+        self.stdout.write(f'Render worker {self.worker_name} started')
+        processed = 0
+
+        try:
+            while not options['max_jobs'] or processed < options['max_jobs']:
+                self.requeue_stale(options['stale_after'], options['max_attempts'])
+                job = self.claim_next_job()
+
+                if job is None:
+                    if options['once']:
+                        break
+                    time.sleep(options['poll_interval'])
+                    continue
+
+                self.run_job(job)
+                processed += 1
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write(f'Render worker {self.worker_name} stopped after {processed} job(s)')
+
+    def start(self, worker_name=None):
+        """Set up the worker state used by run_job()"""
+        self.worker_name = worker_name or f'{socket.gethostname()}:{os.getpid()}'
+        self.generator = ProductIconGenerator()
+        # Batch id (or custom layout key) -> picto overlay; jobs of a batch share one overlay
+        self.overlays = {}
+
+    def requeue_stale(self, stale_after, max_attempts):
+        """Put jobs left running by a dead worker back into the queue
+        A job that already took down `max_attempts` workers fails instead, so that one
+        product crashing its worker cannot be claimed forever
+        """
+        cutoff = timezone.now() - timedelta(seconds=stale_after)
+        stale = RenderJob.objects.filter(status=RenderJob.STATUS_RUNNING, started_at__lt=cutoff)
+
+        failed = stale.filter(attempts__gte=max_attempts).update(
+            status=RenderJob.STATUS_FAILED,
+            error=f'Abandoned by {max_attempts} worker(s), the product may crash the renderer.',
+            finished_at=timezone.now(),
+        )
+        if failed:
+            self.stdout.write(self.style.ERROR(f'Failed {failed} job(s) abandoned {max_attempts} time(s)'))
+
+        requeued = stale.filter(attempts__lt=max_attempts).update(status=RenderJob.STATUS_PENDING, worker='')
+        if requeued:
+            self.stdout.write(self.style.WARNING(f'Requeued {requeued} stale job(s)'))
+
+    def claim_next_job(self):
+        """Atomically move the oldest pending job to running; other workers skip it"""
+        while True:
+            job_id = RenderJob.objects.filter(
+                status=RenderJob.STATUS_PENDING
+            ).order_by('id').values_list('id', flat=True).first()
+
+            if job_id is None:
+                return None
+
+            claimed = RenderJob.objects.filter(id=job_id, status=RenderJob.STATUS_PENDING).update(
+                status=RenderJob.STATUS_RUNNING,
+                worker=self.worker_name,
+                started_at=timezone.now(),
+                attempts=F('attempts') + 1,
+            )
+            if claimed:
+                return RenderJob.objects.select_related('submission__batch').get(id=job_id)
+            # Another worker claimed it first, try the next one
+
+    def get_overlay(self, key, create):
+        overlay = self.overlays.get(key)
+        if overlay is None:
+            overlay = create()
+            # Keep only the batch currently being drained
+            self.overlays = {key: overlay}
+        return overlay
+
+    def render(self, job):
+        """Render the submission of a job, with the batch pictos or the job's custom layout"""
+        submission = job.submission
+        batch = submission.batch
+
+        if job.layout:
+            overlay = self.get_overlay(
+                f'layout-{job.layout["key"]}', lambda: self.generator.create_layout_overlay(job.layout['pictos'])
+            )
+            return render_submission_layout(self.generator, submission, job.layout, overlay)
+
+        if batch:
+            vertical_selections = batch.get_vertical_selections()
+            horizontal_selections = batch.get_horizontal_selections()
+            overlay = self.get_overlay(
+                batch.id, lambda: self.generator.create_overlay(vertical_selections, horizontal_selections)
+            )
+        else:
+            vertical_selections, horizontal_selections, overlay = [], [], None
+        return render_submission(self.generator, submission, vertical_selections, horizontal_selections, overlay)
+
+    def run_job(self, job):
+        submission = job.submission
+
+        try:
+            if self.render(job):
+                job.status = RenderJob.STATUS_DONE
+                job.error = ''
+            else:
+                job.status = RenderJob.STATUS_FAILED
+                job.error = 'Rendering failed, see worker output for details.'
+        except Exception:
+            job.status = RenderJob.STATUS_FAILED
+            job.error = traceback.format_exc()
+
+        job.finished_at = timezone.now()
+        job.save(update_fields=['status', 'error', 'finished_at'])
+
+        style = self.style.SUCCESS if job.status == RenderJob.STATUS_DONE else self.style.ERROR
+        self.stdout.write(style(f'Job {job.id} (product {submission.id}): {job.status}'))
@@ -0,0 +1,242 @@
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: no lock between processes folding exited processes at the same time
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'product_generator_'
+
+# Histogram buckets: latencies in seconds and image counts
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500)
+
+# name -> (type, help[, histogram buckets])
+METRICS = {
+    'render_stage_seconds': ('histogram', 'Time spent in each stage of a product render', SECONDS_BUCKETS),
+    'render_seconds': ('histogram', 'Total time of a product render', SECONDS_BUCKETS),
+    'images_rendered_total': ('counter', 'Product images rendered'),
+    'render_failures_total': ('counter', 'Product renders that failed'),
+    'renders_in_flight': ('gauge', 'Product renders in progress'),
+    'render_cache_hits_total': ('counter', 'Products served from the render cache'),
+    'render_cache_misses_total': ('counter', 'Products not found in the render cache'),
+    'picto_cache_hits_total': ('counter', 'Pictos served from the per-process picto cache'),
+    'picto_cache_misses_total': ('counter', 'Pictos decoded on a picto cache miss'),
+    'batches_total': ('counter', 'Batches submitted, by render mode'),
+    'batch_failures_total': ('counter', 'Batches where no product could be rendered'),
+    'batch_seconds': ('histogram', 'Time to handle a batch upload, by render mode', SECONDS_BUCKETS),
+    'batch_images': ('histogram', 'Product images per batch', COUNT_BUCKETS),
+}
+
+
+# Counters and histograms of exited processes, folded together by collect()
+ARCHIVE_FILE = 'archive.json'
+
+
+def get_metrics_dir():
+    """Directory shared by the processes of a host (gunicorn workers, pool processes)"""
+    return getattr(settings, 'METRICS_DIR', None) or os.path.join(tempfile.gettempdir(), 'product_generator_metrics')
+
+
+class ProcessMetrics:
+    """Metrics of this process, written to `<METRICS_DIR>/<pid>.json` by a background thread
+
+    Updates only touch memory; collect() merges the files of every process, so
+    /metrics reports the same totals whichever gunicorn worker serves it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        self._dirty = False
+        self._pid = None
+
+    def _update(self, kind, name, labels, update):
+        if not getattr(settings, 'METRICS_ENABLED', True):
+            return
+        key = json.dumps([kind, name, sorted(labels.items())])
+        with self._lock:
+            if self._pid != os.getpid():
+                # First update in this process (or in a forked child)
+                self._pid = os.getpid()
+                self._values = {}
+                threading.Thread(target=self._flush_forever, daemon=True).start()
+            self._values[key] = update(self._values.get(key))
+            self._dirty = True
+
+    def inc(self, name, value=1, **labels):
+        self._update('counter', name, labels, lambda current: (current or 0) + value)
+
+    def add(self, name, value, **labels):
+        self._update('gauge', name, labels, lambda current: (current or 0) + value)
+
+    def observe(self, name, value, **labels):
+        bounds = METRICS[name][2]
+
+        def update(current):
+            buckets, total, count = current or ([0] * len(bounds), 0, 0)
+            buckets = [n + (value <= bound) for n, bound in zip(buckets, bounds)]
+            return buckets, total + value, count + 1
+        self._update('histogram', name, labels, update)
+
+    def _flush_forever(self):
+        interval = getattr(settings, 'METRICS_FLUSH_INTERVAL', 1.0)
+        while True:
+            time.sleep(interval)
+            try:
+                self.flush()
+            except OSError as e:
+                logger.warning('Could not write metrics', extra={'error': str(e)})
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps({'pid': self._pid, 'values': self._values})
+            self._dirty = False
+
+        metrics_dir = get_metrics_dir()
+        os.makedirs(metrics_dir, exist_ok=True)
+        path = os.path.join(metrics_dir, f'{self._pid}.json')
+        with open(f'{path}.tmp', 'w') as f:
+            f.write(data)
+        os.replace(f'{path}.tmp', path)
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def read_values(path):
+    """The metrics of a process file (or of the archive), or None if it is gone"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def merge_values(merged, values, gauges=True):
+    """Add `values` (metric key -> value, as in the process files) to `merged`"""
+    for key, value in values.items():
+        kind = json.loads(key)[0]
+        if kind == 'gauge' and not gauges:
+            continue
+        current = merged.get(key)
+        if current is not None:
+            if kind == 'histogram':
+                value = [[a + b for a, b in zip(current[0], value[0])], current[1] + value[1], current[2] + value[2]]
+            else:
+                value += current
+        merged[key] = value
+    return merged
+
+
+def archive_exited(metrics_dir, paths):
+    """Fold the files of exited processes into the archive and delete them; returns the archive
+
+    Like the multiprocess mode of prometheus_client: every restarted worker would otherwise
+    leave a file behind, read again on each scrape. Gauges of exited processes are dropped.
+    """
+    os.makedirs(metrics_dir, exist_ok=True)
+    archive_path = os.path.join(metrics_dir, ARCHIVE_FILE)
+    with open(os.path.join(metrics_dir, 'archive.lock'), 'w') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        archived = (read_values(archive_path) or {}).get('values', {})
+        folded = []
+        for path in paths:
+            # Read again under the lock: another scrape may have folded it already
+            data = read_values(path)
+            if data is None or is_alive(data['pid']):
+                continue
+            merge_values(archived, data['values'], gauges=False)
+            folded.append(path)
+
+        if folded:
+            with open(f'{archive_path}.tmp', 'w') as f:
+                json.dump({'values': archived}, f)
+            os.replace(f'{archive_path}.tmp', archive_path)
+            for path in folded:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+    return archived
+
+
+def collect():
+    """Merge the metrics of every process into the Prometheus text format
+
+    Counters and histograms of exited processes still count towards the totals, through
+    the archive they are folded into; their gauges are dropped.
+    """
+    process_metrics.flush()
+
+    metrics_dir = get_metrics_dir()
+    live = {}
+    exited = []
+    # Process files are named after their pid
+    for path in glob.glob(os.path.join(metrics_dir, '[0-9]*.json')):
+        data = read_values(path)
+        if data is None:
+            continue
+        if is_alive(data['pid']):
+            merge_values(live, data['values'])
+        else:
+            exited.append(path)
+
+    archived = archive_exited(metrics_dir, exited)
+    merged = {}
+    for key, value in merge_values(dict(archived), live).items():
+        _, name, labels = json.loads(key)
+        merged[(name, tuple(tuple(label) for label in labels))] = value
+
+    lines = []
+    for name, (kind, description, *_) in METRICS.items():
+        lines.append(f'# HELP {PREFIX}{name} {description}')
+        lines.append(f'# TYPE {PREFIX}{name} {kind}')
+        for (metric_name, labels), value in sorted(merged.items()):
+            if metric_name != name:
+                continue
+            if kind == 'histogram':
+                counts, total, count = value
+                for bound, n in zip(METRICS[name][2], counts):
+                    lines.append(f'{PREFIX}{name}_bucket{format_labels(labels + (("le", str(bound)),))} {n}')
+                lines.append(f'{PREFIX}{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {count}')
+                lines.append(f'{PREFIX}{name}_sum{format_labels(labels)} {total}')
+                lines.append(f'{PREFIX}{name}_count{format_labels(labels)} {count}')
+            else:
+                lines.append(f'{PREFIX}{name}{format_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{key}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+
+process_metrics = ProcessMetrics()
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('generator', '0007_rendercacheentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productsubmission',
+            name='thumbnail_medium',
+            field=models.ImageField(blank=True, null=True, upload_to='results/thumbs/'),
+        ),
+        migrations.AddField(
+            model_name='productsubmission',
+            name='thumbnail_small',
+            field=models.ImageField(blank=True, null=True, upload_to='results/thumbs/'),
+        ),
+    ]
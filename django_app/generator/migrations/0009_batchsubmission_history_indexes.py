@@ -0,0 +1,57 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('generator', '0008_productsubmission_thumbnails'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='batchsubmission',
+            index=models.Index(fields=['created_at', 'id'], name='batch_created_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='batchsubmission',
+            index=models.Index(fields=['vertical_pos_1', 'created_at', 'id'], name='batch_vpos1_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='batchsubmission',
+            index=models.Index(fields=['vertical_pos_2', 'created_at', 'id'], name='batch_vpos2_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='batchsubmission',
+            index=models.Index(fields=['vertical_pos_3', 'created_at', 'id'], name='batch_vpos3_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='batchsubmission',
+            index=models.Index(fields=['vertical_pos_4', 'created_at', 'id'], name='batch_vpos4_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='batchsubmission',
+            index=models.Index(fields=['vertical_pos_5', 'created_at', 'id'], name='batch_vpos5_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='batchsubmission',
+            index=models.Index(fields=['horizontal_file_1', 'created_at', 'id'], name='batch_hfile1_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='batchsubmission',
+            index=models.Index(fields=['horizontal_file_2', 'created_at', 'id'], name='batch_hfile2_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='batchsubmission',
+            index=models.Index(fields=['horizontal_file_3', 'created_at', 'id'], name='batch_hfile3_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='batchsubmission',
+            index=models.Index(fields=['horizontal_file_4', 'created_at', 'id'], name='batch_hfile4_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='batchsubmission',
+            index=models.Index(fields=['horizontal_file_5', 'created_at', 'id'], name='batch_hfile5_created_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('generator', '0009_batchsubmission_history_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='productsubmission',
+            name='product_image',
+            field=models.ImageField(db_index=True, upload_to='products/'),
+        ),
+        migrations.AlterField(
+            model_name='productsubmission',
+            name='result_image',
+            field=models.ImageField(blank=True, db_index=True, null=True, upload_to='results/'),
+        ),
+        migrations.AlterField(
+            model_name='rendercacheentry',
+            name='result_image',
+            field=models.ImageField(db_index=True, upload_to='results/'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('generator', '0010_media_name_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='renderjob',
+            name='layout',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
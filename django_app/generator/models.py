@@ -1,6 +1,21 @@
+import os
 from django.db import models
 
 
+# Result thumbnails rendered alongside each full-size image: model field -> width in px
+THUMBNAIL_FIELDS = {
+    'thumbnail_small': 200,
+    'thumbnail_medium': 400,
+}
+
+
+def get_thumbnail_path(result_path, size):
+    """Thumbnail of a result image, e.g. results/thumbs/result_x_200.webp for results/result_x.webp"""
+    directory, filename = os.path.split(result_path)
+    base_name, extension = os.path.splitext(filename)
+    return os.path.join(directory, 'thumbs', f'{base_name}_{size}{extension}')
+
+
 class BatchSubmission(models.Model):
     """Model to group multiple product submissions together"""
     # Vertical picto positions (shared across all images in batch)
@@ -24,16 +39,98 @@ class BatchSubmission(models.Model):
     
     created_at = models.DateTimeField(auto_now_add=True)
     
+    class Meta:
+        # Batch history: newest first with keyset pagination on (created_at, id), optionally
+        # filtered on a picto; one index per picto position keeps each filter an index range scan
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='batch_created_id_idx'),
+            *[
+                models.Index(fields=[f'vertical_pos_{i}', 'created_at', 'id'], name=f'batch_vpos{i}_created_idx')
+                for i in range(1, 6)
+            ],
+            *[
+                models.Index(fields=[f'horizontal_file_{i}', 'created_at', 'id'], name=f'batch_hfile{i}_created_idx')
+                for i in range(1, 6)
+            ],
+        ]
+    
     def __str__(self):
         return f"Batch {self.id} - {self.created_at}"
+    
+    def get_vertical_selections(self):
+        """Vertical picto filenames by position (1 = bottom)"""
+        return [
+            self.vertical_pos_1, self.vertical_pos_2, self.vertical_pos_3,
+            self.vertical_pos_4, self.vertical_pos_5
+        ]
+    
+    def get_horizontal_selections(self):
+        """Horizontal (category, filename) pairs by position (1 = bottom)"""
+        return [
+            (self.horizontal_cat_1, self.horizontal_file_1),
+            (self.horizontal_cat_2, self.horizontal_file_2),
+            (self.horizontal_cat_3, self.horizontal_file_3),
+            (self.horizontal_cat_4, self.horizontal_file_4),
+            (self.horizontal_cat_5, self.horizontal_file_5),
+        ]
 
 
 class ProductSubmission(models.Model):
     """Model to store individual product submissions and their results"""
     batch = models.ForeignKey(BatchSubmission, on_delete=models.CASCADE, related_name='products', null=True, blank=True)
-    product_image = models.ImageField(upload_to='products/')
-    result_image = models.ImageField(upload_to='results/', null=True, blank=True)
+    # Indexed: files are looked up by name (render cache eviction, `manage.py prune_media`)
+    product_image = models.ImageField(upload_to='products/', db_index=True)
+    result_image = models.ImageField(upload_to='results/', null=True, blank=True, db_index=True)
+    # Downscaled copies of result_image for the result pages (srcset)
+    thumbnail_small = models.ImageField(upload_to='results/thumbs/', null=True, blank=True)
+    thumbnail_medium = models.ImageField(upload_to='results/thumbs/', null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     
     def __str__(self):
         return f"Product {self.id} - {self.created_at}"
+
+
+class RenderJob(models.Model):
+    """Queued render of a product submission, drained by `manage.py render_worker`"""
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+    
+    submission = models.OneToOneField(ProductSubmission, on_delete=models.CASCADE, related_name='render_job')
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    worker = models.CharField(max_length=255, blank=True, default='')
+    error = models.TextField(blank=True, default='')
+    # Custom layout of a preview editor re-render (see views.compile_layout), None for the batch pictos
+    layout = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'id'], name='renderjob_status_id_idx'),
+        ]
+    
+    def __str__(self):
+        return f"RenderJob {self.id} ({self.status}) - Product {self.submission_id}"
+
+
+class RenderCacheEntry(models.Model):
+    """Result of a render, addressed by a hash of everything that determines its pixels"""
+    key = models.CharField(max_length=64, unique=True)
+    result_image = models.ImageField(upload_to='results/', db_index=True)
+    size = models.PositiveBigIntegerField(default=0)
+    hits = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    
+    def __str__(self):
+        return f"RenderCacheEntry {self.key[:12]} ({self.hits} hits)"
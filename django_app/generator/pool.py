@@ -0,0 +1,269 @@
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from django.conf import settings
+from django.db import close_old_connections
+
+
+logger = logging.getLogger(__name__)
+
+
+# Pool shared by every request served by this (gunicorn) worker process
+_executor = None
+_executor_lock = threading.Lock()
+
+# Threads running the blocking part of async views (see run_in_render_thread)
+_thread_executor = None
+
+# Threads saving result files to the storage (see get_upload_executor)
+_upload_executor = None
+
+# State of each pool process, set up by _init_pool_process()
+_generator = None
+_overlay_batch_id = None
+_overlay = None
+
+
+def get_pool_size():
+    """Number of render processes, RENDER_POOL_WORKERS or one per CPU"""
+    return getattr(settings, 'RENDER_POOL_WORKERS', 0) or os.cpu_count() or 1
+
+
+def _init_pool_process():
+    """Give each pool process its own warm ProductIconGenerator"""
+    global _generator
+    import django
+    django.setup()
+    from .views import ProductIconGenerator
+    _generator = ProductIconGenerator()
+
+
+def _render_in_pool(batch_id, product_name, vertical_selections, horizontal_selections, output_name, layout=None):
+    """Render one stored product inside a pool process, reusing the overlay of the current batch"""
+    global _overlay_batch_id, _overlay
+    if _overlay is None or _overlay_batch_id != batch_id:
+        _overlay = create_batch_overlay(_generator, vertical_selections, horizontal_selections, layout)
+        _overlay_batch_id = batch_id
+    return render_stored_product(
+        _generator, product_name, vertical_selections, horizontal_selections, _overlay, output_name,
+        product_box=layout and layout['product']
+    )
+
+
+def create_batch_overlay(generator, vertical_selections, horizontal_selections, layout=None):
+    """Picto layer of a batch: its selections, or a custom layout (see views.compile_layout)"""
+    if layout is not None:
+        return generator.create_layout_overlay(layout['pictos'])
+    return generator.create_overlay(vertical_selections, horizontal_selections)
+
+
+def render_stored_product(generator, product_name, vertical_selections, horizontal_selections, overlay, output_name,
+                          product_box=None):
+    """Render a product read from the storage; returns the result name or None"""
+    from django.core.files.storage import default_storage
+    try:
+        product_file = default_storage.open(product_name, 'rb')
+    except OSError as e:
+        logger.warning('Error opening product', extra={'product': product_name, 'error': str(e)})
+        return None
+    with product_file:
+        return generator.process_product(
+            product_file,
+            vertical_selections,
+            horizontal_selections,
+            overlay=overlay,
+            output_name=output_name,
+            product_box=product_box
+        )
+
+
+def estimate_stored_memory(generator, product_name):
+    """estimate_memory() of a product in the storage (only its header is parsed)"""
+    from django.core.files.storage import default_storage
+    try:
+        with default_storage.open(product_name, 'rb') as product_file:
+            return generator.estimate_memory(product_file)
+    except OSError:
+        return 0
+
+
+def get_executor():
+    """Return the process pool, starting it on first use"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # spawn: pool processes must not inherit the parent's DB connections
+            _executor = ProcessPoolExecutor(
+                max_workers=get_pool_size(),
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_pool_process,
+            )
+        return _executor
+
+
+def get_pool_pids():
+    """Process ids of the render pool processes, none before the pool is first used"""
+    with _executor_lock:
+        if _executor is None:
+            return []
+        return list(_executor._processes or {})
+
+
+def shutdown_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+def get_render_threads():
+    """Number of render threads, RENDER_THREADS or one per CPU"""
+    return getattr(settings, 'RENDER_THREADS', 0) or os.cpu_count() or 1
+
+
+def get_thread_executor():
+    """Return the render threads of this process, starting them on first use"""
+    global _thread_executor
+    with _executor_lock:
+        if _thread_executor is None:
+            _thread_executor = ThreadPoolExecutor(max_workers=get_render_threads(), thread_name_prefix='render')
+        return _thread_executor
+
+
+def _run_with_connections(func, *args, **kwargs):
+    # Render threads outlive requests: drop their connection like a request would
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+def get_upload_executor():
+    """Threads saving the files of a result (image and thumbnails) at once, RESULT_UPLOAD_THREADS
+
+    Shared by the renders of the process. None when files are saved one after the other
+    (RESULT_UPLOAD_THREADS=0, the default).
+    """
+    global _upload_executor
+    upload_threads = getattr(settings, 'RESULT_UPLOAD_THREADS', 0)
+    if upload_threads <= 0:
+        return None
+    with _executor_lock:
+        if _upload_executor is None:
+            _upload_executor = ThreadPoolExecutor(max_workers=upload_threads, thread_name_prefix='upload')
+        return _upload_executor
+
+
+async def run_in_render_thread(func, *args, **kwargs):
+    """Run blocking `func` (Pillow work and its database writes) without blocking the event loop
+
+    At most RENDER_THREADS calls run at once per process; the others wait their turn, so
+    concurrent batches cannot starve lightweight requests of threads and CPU.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_thread_executor(), functools.partial(_run_with_connections, func, *args, **kwargs)
+    )
+
+
+async def iterate_in_render_thread(iterator):
+    """Async iterator over blocking `iterator`, advanced one item at a time on the render threads
+
+    For StreamingHttpResponse under ASGI: Django would otherwise collect a sync iterator
+    into a list on its single thread-sensitive executor before sending the first byte.
+    """
+    iterator = iter(iterator)
+    done = object()
+    try:
+        while True:
+            item = await run_in_render_thread(next, iterator, done)
+            if item is done:
+                return
+            yield item
+    finally:
+        # Client gone or stream finished: let a generator release its files
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            close()
+
+
+def _render_in_pool_timed(*args):
+    started = time.perf_counter()
+    return _render_in_pool(*args), time.perf_counter() - started
+
+
+def iter_render_batch(batch_id, product_names, vertical_selections, horizontal_selections, output_names=None,
+                      generator=None, layout=None):
+    """Render the products of a batch across the process pool
+
+    `product_names` are storage names (the pool processes read the products from the
+    storage, whichever backend it is). Yields (index in `product_names`, result name or
+    None, render seconds) as each product completes, so callers can report results before
+    the slowest one is done. `output_names` optionally names each result (default: the
+    product name). A `layout` from views.compile_layout() replaces the selections; pool
+    processes reuse their overlay while `batch_id` stays the same.
+    At most one product per pool process is in flight, and only while the estimated
+    memory of the products in flight fits RENDER_MEMORY_BUDGET (one always runs).
+    If the pool breaks (e.g. a process was OOM-killed) the remaining products are rendered
+    in-process with `generator` and the pool is recreated on the next call.
+    """
+    if not product_names:
+        return
+
+    if output_names is None:
+        output_names = product_names
+    if generator is None:
+        from .views import ProductIconGenerator
+        generator = ProductIconGenerator()
+
+    budget = getattr(settings, 'RENDER_MEMORY_BUDGET', 0)
+    costs = [estimate_stored_memory(generator, name) if budget else 0 for name in product_names]
+    max_in_flight = get_pool_size()
+
+    executor = get_executor()
+    done = set()
+    try:
+        futures = {}
+        in_flight_bytes = 0
+        next_index = 0
+        while next_index < len(product_names) or futures:
+            while next_index < len(product_names) and len(futures) < max_in_flight and (
+                    not futures or not budget or in_flight_bytes + costs[next_index] <= budget):
+                future = executor.submit(
+                    _render_in_pool_timed, batch_id, product_names[next_index],
+                    vertical_selections, horizontal_selections, output_names[next_index], layout
+                )
+                futures[future] = next_index
+                in_flight_bytes += costs[next_index]
+                next_index += 1
+
+            finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in finished:
+                index = futures.pop(future)
+                in_flight_bytes -= costs[index]
+                result_path, seconds = future.result()
+                done.add(index)
+                yield index, result_path, seconds
+        return
+    except BrokenProcessPool:
+        logger.error('Render pool broke, finishing batch in-process', extra={'batch_id': batch_id})
+        shutdown_executor()
+
+    overlay = create_batch_overlay(generator, vertical_selections, horizontal_selections, layout)
+    for index, (product_name, output_name) in enumerate(zip(product_names, output_names)):
+        if index in done:
+            continue
+        started = time.perf_counter()
+        result_path = render_stored_product(
+            generator, product_name, vertical_selections, horizontal_selections, overlay, output_name,
+            product_box=layout and layout['product']
+        )
+        yield index, result_path, time.perf_counter() - started
@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+from .metrics import process_metrics
+from .models import ProductSubmission, RenderCacheEntry, THUMBNAIL_FIELDS, get_thumbnail_path
+
+
+# Bump when a rendering change alters the output for the same inputs
+RENDER_CACHE_VERSION = 1
+
+
+def is_enabled():
+    return getattr(settings, 'RENDER_CACHE_ENABLED', True)
+
+
+def get_picto_versions(generator, vertical_selections, horizontal_selections):
+    """Normalized picto selection: (position, file, mtime) of every picto that gets rendered"""
+    pictos = []
+    for i, filename in enumerate(vertical_selections):
+        if filename and filename.strip():
+            pictos.append(('vertical', i, os.path.join(generator.vertical_dir, filename.strip())))
+    for i, (category, filename) in enumerate(horizontal_selections):
+        if category and filename:
+            pictos.append(('horizontal', i, os.path.join(generator.horizontal_dir, category, filename)))
+
+    versions = []
+    for side, position, path in pictos:
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            # Missing pictos are skipped by the renderer
+            mtime = None
+        versions.append([side, position, os.path.relpath(path, generator.data_dir), mtime])
+    return versions
+
+
+def make_key(generator, product_file, vertical_selections, horizontal_selections):
+    """Hash the product bytes, picto selection, background version and encoder settings
+
+    `product_file` is an open file or upload; it is read in chunks and rewound.
+    """
+    digest = hashlib.sha256()
+    product_file.seek(0)
+    if hasattr(product_file, 'chunks'):
+        for chunk in product_file.chunks():
+            digest.update(chunk)
+    else:
+        for chunk in iter(lambda: product_file.read(64 * 1024), b''):
+            digest.update(chunk)
+    product_file.seek(0)
+
+    digest.update(json.dumps({
+        'version': RENDER_CACHE_VERSION,
+        'pictos': get_picto_versions(generator, vertical_selections, horizontal_selections),
+        'settings': generator.get_render_settings(),
+    }, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def get_output_name(name, key):
+    """Result base name carrying the cache key, so results of different content never collide"""
+    base_name = os.path.splitext(os.path.basename(name))[0]
+    return f'{base_name}_{key[:12]}'
+
+
+def lookup_many(keys):
+    """Return {key: cached result path} for the keys present in the cache, in one query"""
+    if not is_enabled() or not keys:
+        return {}
+
+    found = {}
+    missing_files = []
+    for entry in RenderCacheEntry.objects.filter(key__in=set(keys)):
+        if default_storage.exists(entry.result_image.name):
+            found[entry.key] = entry.result_image.name
+        else:
+            # Result was removed behind the cache's back
+            missing_files.append(entry.pk)
+
+    process_metrics.inc('render_cache_hits_total', len(found))
+    process_metrics.inc('render_cache_misses_total', len(set(keys)) - len(found))
+
+    if missing_files:
+        RenderCacheEntry.objects.filter(pk__in=missing_files).delete()
+    if found:
+        RenderCacheEntry.objects.filter(key__in=found).update(hits=F('hits') + 1, last_used_at=timezone.now())
+    return found
+
+
+def store_many(renders):
+    """Remember freshly rendered (key, result path) pairs in one insert
+
+    Entries beyond the size budget are evicted once the surrounding transaction commits.
+    """
+    if not is_enabled() or not renders:
+        return
+
+    entries = {}
+    for key, result_path in renders:
+        try:
+            size = default_storage.size(result_path)
+        except OSError:
+            size = 0
+        entries[key] = RenderCacheEntry(key=key, result_image=result_path, size=size)
+
+    # Renders stored concurrently by another worker are kept as they are
+    RenderCacheEntry.objects.bulk_create(entries.values(), ignore_conflicts=True)
+    transaction.on_commit(evict)
+
+
+def evict():
+    """Drop least recently used entries until the cache fits RENDER_CACHE_MAX_BYTES
+
+    Result files still used by a ProductSubmission are kept (they only stop being
+    reused); unreferenced files are deleted along with their entry.
+    """
+    max_bytes = getattr(settings, 'RENDER_CACHE_MAX_BYTES', 1024 * 1024 * 1024)
+    total = RenderCacheEntry.objects.aggregate(total=Sum('size'))['total'] or 0
+
+    while total > max_bytes:
+        entries = list(RenderCacheEntry.objects.order_by('last_used_at', 'id')[:100])
+        if not entries:
+            break
+
+        for entry in entries:
+            if total <= max_bytes:
+                break
+            name = entry.result_image.name
+            entry.delete()
+            total -= entry.size
+            if not ProductSubmission.objects.filter(result_image=name).exists():
+                default_storage.delete(name)
+                for size in THUMBNAIL_FIELDS.values():
+                    default_storage.delete(get_thumbnail_path(name, size))
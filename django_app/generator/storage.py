@@ -0,0 +1,43 @@
+import os
+import tempfile
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import FileSystemStorage
+
+
+class ResultFileSystemStorage(FileSystemStorage):
+    """FileSystemStorage saving under exactly the name asked for, atomically replacing a file there
+
+    Result names are derived from what they render (render cache key, layout hash), so a
+    render is saved over the previous one instead of under a free variant of the name.
+    The content is written to a temporary file of the same directory, then renamed over
+    the name: a reader, or a submission linked to the same result by the render cache,
+    sees the previous file or the new one, never a missing or partial one. The S3 backend
+    gets the same from `file_overwrite=True` (one PUT replaces the object), see STORAGES.
+    """
+
+    def get_available_name(self, name, max_length=None):
+        name = str(name).replace('\\', '/')
+        if max_length is not None and len(name) > max_length:
+            raise SuspiciousFileOperation(f'Storage can not find an available filename for "{name}".')
+        return name
+
+    def _save(self, name, content):
+        full_path = self.path(name)
+        directory = os.path.dirname(full_path)
+        os.makedirs(directory, exist_ok=True)
+
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in content.chunks():
+                    f.write(chunk)
+            # mkstemp creates the file readable by its owner only
+            os.chmod(temp_path, self.file_permissions_mode if self.file_permissions_mode is not None else 0o644)
+            os.replace(temp_path, full_path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        return str(name).replace('\\', '/')
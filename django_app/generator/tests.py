@@ -0,0 +1,159 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from PIL import Image
+
+from .atlas import PictoAtlas, get_atlas_dir, get_atlas_sizes
+from .catalog import picto_catalog
+from .models import BatchSubmission, ProductSubmission
+from .views import ProductIconGenerator
+
+
+class MediaTestCase(TestCase):
+    """Runs each test against an empty temporary MEDIA_ROOT"""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media_settings = override_settings(MEDIA_ROOT=self.media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+    def write_media(self, name, content=b'data', age_hours=0):
+        path = os.path.join(self.media_root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        modified = time.time() - age_hours * 3600
+        os.utime(path, (modified, modified))
+        return path
+
+
+class PruneMediaTests(MediaTestCase):
+    def prune(self, **options):
+        output = StringIO()
+        call_command('prune_media', io_budget=0, stdout=output, **options)
+        return output.getvalue()
+
+    def test_deletes_strays_at_the_storage_root(self):
+        stray = self.write_media('result_prod1_lU5oG8E.jpg.old', age_hours=48)
+        nested_stray = self.write_media('results/result_gone.webp', age_hours=48)
+        result = self.write_media('results/result_prod1.webp', age_hours=48)
+        product = self.write_media('products/prod1.jpg', age_hours=48)
+        ProductSubmission.objects.create(product_image='products/prod1.jpg', result_image='results/result_prod1.webp')
+
+        self.prune()
+
+        self.assertFalse(os.path.exists(stray))
+        self.assertFalse(os.path.exists(nested_stray))
+        self.assertTrue(os.path.exists(result))
+        self.assertTrue(os.path.exists(product))
+
+    def test_dry_run_reports_root_strays_without_deleting(self):
+        stray = self.write_media('result_prod1_lU5oG8E.jpg.old', age_hours=48)
+        recent = self.write_media('result_prod2.jpg')
+
+        output = self.prune(dry_run=True)
+
+        self.assertIn('Would delete 1 orphaned file(s) out of 2 scanned', output)
+        self.assertTrue(os.path.exists(stray))
+        self.assertTrue(os.path.exists(recent))
+
+
+class PictoAtlasTests(TestCase):
+    def setUp(self):
+        atlas_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, atlas_dir, ignore_errors=True)
+        atlas_settings = override_settings(PICTO_ATLAS_DIR=atlas_dir, PICTO_ATLAS_ENABLED=True)
+        atlas_settings.enable()
+        self.addCleanup(atlas_settings.disable)
+
+        self.generator = ProductIconGenerator()
+        filename, _ = picto_catalog.get_vertical_pictos()[0]
+        self.picto_path = os.path.join(picto_catalog.vertical_dir, filename)
+        self.atlas = PictoAtlas()
+        paths = mock.patch.object(self.atlas, '_get_picto_paths', return_value=[self.picto_path])
+        paths.start()
+        self.addCleanup(paths.stop)
+        self.size = get_atlas_sizes()[0]
+        self.atlas.build(self.generator._decode_picto)
+
+    def test_crops_pictos_out_of_the_atlas(self):
+        picto = self.atlas.get(self.picto_path, self.size, self.generator._decode_picto)
+
+        self.assertEqual(picto.tobytes(), self.generator._decode_picto(self.picto_path, self.size).tobytes())
+
+    def test_decodes_when_the_atlas_file_vanishes_after_the_index_is_read(self):
+        load_index = self.atlas._load_index
+
+        def load_index_then_rebuild():
+            index = load_index()
+            # A rebuild by another process replaces the file the index points to
+            os.remove(os.path.join(get_atlas_dir(), index['file']))
+            return index
+
+        with mock.patch.object(self.atlas, '_load_index', side_effect=load_index_then_rebuild), \
+                mock.patch('generator.views.picto_atlas', self.atlas), \
+                self.assertLogs('generator.atlas', 'WARNING'):
+            self.assertIsNone(self.atlas.get(self.picto_path, self.size, self.generator._decode_picto))
+            picto = self.generator._load_picto(self.picto_path, self.size)
+
+        self.assertEqual(picto.tobytes(), self.generator._decode_picto(self.picto_path, self.size).tobytes())
+
+
+@override_settings(API_TOKENS=['test-token'])
+class BulkGenerateManifestTests(TestCase):
+    def post_manifest(self, manifest):
+        return self.client.post(
+            reverse('api_bulk_generate'), data=json.dumps(manifest), content_type='application/json',
+            HTTP_AUTHORIZATION='Bearer test-token',
+        )
+
+    def test_rejects_non_string_product_sources(self):
+        for product in [{'path': ['x']}, {'path': {'x': 1}}, {'file': ['x']}, {'file': {'x': 1}}, {'file': 3}]:
+            with self.subTest(product=product):
+                response = self.post_manifest({'products': [product]})
+
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json(), {'error': 'Product `file` and `path` must be strings.'})
+        self.assertFalse(ProductSubmission.objects.exists())
+
+
+class CenterProductTests(TestCase):
+    def test_centers_the_product_in_the_layout_product_box(self):
+        generator = ProductIconGenerator('marketplace')
+        background = Image.new('RGBA', (generator.background_width, generator.background_height), (0, 0, 0, 0))
+
+        placed = generator.center_product(Image.new('RGB', (300, 100), (255, 0, 0)), background)
+
+        left, top, right, bottom = generator.plan.product_box
+        placed_left, placed_top, placed_right, placed_bottom = placed.getbbox()
+        self.assertEqual((placed_left, placed_right), (left, right))
+        self.assertEqual(placed_top - top, bottom - placed_bottom)
+
+
+class BatchHistoryFilterTests(TestCase):
+    def setUp(self):
+        self.bio = BatchSubmission.objects.create(horizontal_cat_2='Labels', horizontal_file_2='bio.png')
+        self.vegan = BatchSubmission.objects.create(horizontal_cat_1='Labels', horizontal_file_1='vegan.png')
+
+    def get_batches(self, horizontal):
+        response = self.client.get(reverse('batch_history'), {'horizontal': horizontal})
+        self.assertEqual(response.status_code, 200)
+        return [batch.id for batch in response.context['batches']]
+
+    def test_matches_a_category_and_file(self):
+        self.assertEqual(self.get_batches('Labels/bio.png'), [self.bio.id])
+        self.assertEqual(self.get_batches('Other/bio.png'), [])
+
+    def test_matches_a_bare_file_name_in_any_category(self):
+        self.assertEqual(self.get_batches('bio.png'), [self.bio.id])
+        self.assertEqual(self.get_batches('missing.png'), [])
@@ -1,9 +1,17 @@
 from django.urls import path
-from . import views
+from . import api, views
 
 urlpatterns = [
     path('', views.home, name='home'),
     path('result/<int:submission_id>/', views.result, name='result'),
     path('batch/<int:batch_id>/', views.batch_result, name='batch_result'),
+    path('batch/<int:batch_id>/download/', views.batch_download, name='batch_download'),
+    path('history/', views.batch_history, name='batch_history'),
+    path('api/batch/<int:batch_id>/status/', views.batch_status, name='batch_status'),
+    path('api/catalog/', views.picto_catalog_api, name='picto_catalog'),
+    path('api/batch/<int:batch_id>/render/', views.render_layout, name='render_batch_layout'),
+    path('api/result/<int:submission_id>/render/', views.render_layout, name='render_submission_layout'),
+    path('api/v1/generate/', api.bulk_generate, name='api_bulk_generate'),
+    path('metrics', views.metrics, name='metrics'),
     path('api/horizontal-files/', views.get_horizontal_files, name='get_horizontal_files'),
 ] 
\ No newline at end of file
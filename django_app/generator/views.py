@@ -1,36 +1,75 @@
+from asgiref.sync import sync_to_async
 from django.shortcuts import render, redirect
-from django.http import JsonResponse
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, OuterRef, Prefetch, Q, Subquery
+from django.http import HttpResponse, HttpResponseNotAllowed, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.views.decorators.cache import cache_control
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition, require_GET
 from django.contrib import messages
-from django.core.files.storage import default_storage
+from django.core.handlers.asgi import ASGIRequest
 from django.core.files.base import ContentFile
-from .forms import ProductSubmissionForm, get_horizontal_files_for_category
-from .models import ProductSubmission, BatchSubmission
+from django.core.files.storage import default_storage, storages
+from .forms import ProductSubmissionForm
+from .models import ProductSubmission, BatchSubmission, RenderJob, THUMBNAIL_FIELDS, get_thumbnail_path
+from .atlas import picto_atlas
+from .layouts import get_render_plan
+from .caches import background_cache, picto_cache
+from .catalog import PICTO_EXTENSIONS, picto_catalog
+from .pool import get_upload_executor, iter_render_batch, iterate_in_render_thread, run_in_render_thread
+from .archive import stream_zip
+from .metrics import collect as collect_metrics, process_metrics
+from . import render_cache
 import os
+import re
 import sys
 import json
+import hashlib
+import logging
+import time
 from PIL import Image
 import requests
 from io import BytesIO
+from contextlib import contextmanager
+from datetime import datetime
+from urllib.parse import unquote, urlencode
+
+
+logger = logging.getLogger(__name__)
+
+# Batch history: batches per page and result thumbnails shown per batch
+HISTORY_PAGE_SIZE = 25
+HISTORY_PREVIEW_COUNT = 4
 
 
 class ProductIconGenerator:
-    def __init__(self):
-        self.background_width = 800
-        self.background_height = 800
+    def __init__(self, layout=None):
+        # Canvas, product box and picto slots of the layout (default: RENDER_LAYOUT)
+        self.plan = get_render_plan(layout)
+        self.background_width = self.plan.width
+        self.background_height = self.plan.height
+        self.product_max_size = self.plan.product_size
         # Base directory for data files
         self.base_dir = os.path.dirname(os.path.dirname(__file__))
         self.data_dir = os.path.join(self.base_dir, 'Data')
         self.vertical_dir = os.path.join(self.data_dir, 'Vertical_pictos')
         self.horizontal_dir = os.path.join(self.data_dir, 'horizantal_Pictos')
-    
-    def create_background(self):
-        """Load the background image file from multiple possible locations"""
-        base_dir = os.path.dirname(os.path.dirname(__file__))  # django_app/
-        root_dir = os.path.dirname(base_dir)  # micro/
-        possible_paths = [
-            os.path.join(base_dir, 'backgrounds', 'background.jpg'),
-            os.path.join(base_dir, 'backgrounds', 'background.png'),
+        # Seconds spent per stage by the last process_product() call
+        self.stage_times = {}
+        # Encoder settings of the result images
+        self.output_format = 'WEBP'
+        self.output_quality = 95
+        self.thumbnail_quality = 85
+        # Where results are saved (bench_render swaps in a temporary directory)
+        self.storage = storages['results']
+        
+        # Background locations, in order of preference
+        root_dir = os.path.dirname(self.base_dir)  # micro/
+        self.background_paths = [
+            os.path.join(self.base_dir, 'backgrounds', 'background.jpg'),
+            os.path.join(self.base_dir, 'backgrounds', 'background.png'),
             os.path.join(root_dir, 'background.jpg'),
             os.path.join(root_dir, 'background.png'),
             os.path.join(root_dir, 'backgrounds', 'background.jpg'),
@@ -38,266 +77,571 @@ class ProductIconGenerator:
             os.path.join(root_dir, 'img', 'background.jpg'),
             os.path.join(root_dir, 'img', 'background.png')
         ]
+    
+    def get_render_settings(self):
+        """Everything besides the product and picto files that changes the rendered bytes"""
+        return {
+            'background': background_cache.version(self.background_paths),
+            'layout': self.plan.signature,
+            'format': self.output_format,
+            'quality': self.output_quality,
+            'thumbnails': sorted(THUMBNAIL_FIELDS.values()),
+            'thumbnail_quality': self.thumbnail_quality,
+        }
+    
+    @contextmanager
+    def timed_stage(self, stage):
+        """Add the time spent in the block to `stage_times[stage]`"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_times[stage] = self.stage_times.get(stage, 0) + time.perf_counter() - started
+    
+    def create_background(self):
+        """Return a fresh RGBA copy of the cached background from the first location that exists"""
+        background = background_cache.get(self.background_paths, (self.background_width, self.background_height))
+        if background is not None:
+            return background
         
-        for path in possible_paths:
-            try:
-                background = Image.open(path)
-                print(f"✅ Loaded background from: {path}")
-                if background.size != (self.background_width, self.background_height):
-                    background = background.resize((self.background_width, self.background_height), Image.Resampling.LANCZOS)
-                return background
-            except FileNotFoundError:
-                continue
-            except Exception as e:
-                print(f"❌ Error loading {path}: {e}")
-                continue
-        
-        print("⚠️  No background image found. Creating a simple white background.")
-        background = Image.new('RGB', (self.background_width, self.background_height), (255, 255, 255))
+        logger.warning('No background image found, using a plain white background')
+        background = Image.new('RGBA', (self.background_width, self.background_height), (255, 255, 255, 255))
         return background
     
-    def center_product(self, product_image, background):
-        """Center the product image directly on the background image without frame"""
-        max_size = 350
-        product_width, product_height = product_image.size
+    def get_fit_size(self, product_size):
+        """(width, height) of a product of `product_size` fitted in the product box"""
+        max_size = self.product_max_size
+        product_width, product_height = product_size
         
         if product_width > product_height:
-            new_width = max_size
-            new_height = int((product_height * max_size) / product_width)
+            return max_size, int((product_height * max_size) / product_width)
+        return int((product_width * max_size) / product_height), max_size
+    
+    def resize_product(self, product_image):
+        """Scale the product to fit the product box, in RGBA"""
+        with self.timed_stage('resize'):
+            product_image = product_image.resize(self.get_fit_size(product_image.size), Image.Resampling.LANCZOS)
+            
+            # Ensure product image has transparency (RGBA)
+            if product_image.mode != 'RGBA':
+                product_image = product_image.convert('RGBA')
+        
+        return product_image
+    
+    def center_product(self, product_image, background):
+        """Center the product image in the layout's product box, directly on the background without frame"""
+        product_image = self.resize_product(product_image)
+        
+        with self.timed_stage('composite'):
+            # Ensure background is in RGBA mode for proper alpha blending
+            if background.mode != 'RGBA':
+                background = background.convert('RGBA')
+            
+            left, top, right, bottom = self.plan.product_box
+            product_x = left + (right - left - product_image.size[0]) // 2
+            product_y = top + (bottom - top - product_image.size[1]) // 2
+            
+            # Paste product image with alpha channel to blend naturally (no white frame)
+            background.paste(product_image, (product_x, product_y), product_image)
+        
+        return background
+    
+    def place_product(self, product_image, background, product_box):
+        """Place the product as laid out in the preview editor
+        `product_box` gives the center (x, y) in canvas pixels, `flipped` and the size: either
+        `scale_x`/`scale_y`, relative to the size the product is centered at, or `width`/`height`
+        in canvas pixels. With `fit` the product is fitted inside width x height, keeping its
+        aspect ratio; otherwise the aspect ratio is not preserved when the user unlocked it
+        """
+        if 'scale_x' in product_box:
+            fit_width, fit_height = self.get_fit_size(product_image.size)
+            size = (fit_width * product_box['scale_x'], fit_height * product_box['scale_y'])
+        elif product_box.get('fit'):
+            scale = min(product_box['width'] / product_image.width, product_box['height'] / product_image.height)
+            size = (product_image.width * scale, product_image.height * scale)
         else:
-            new_height = max_size
-            new_width = int((product_width * max_size) / product_height)
+            size = (product_box['width'], product_box['height'])
+        # Never larger than twice the canvas, whatever the product's aspect ratio
+        size = (
+            max(1, min(round(size[0]), 2 * self.background_width)),
+            max(1, min(round(size[1]), 2 * self.background_height)),
+        )
+        with self.timed_stage('resize'):
+            product_image = product_image.resize(size, Image.Resampling.LANCZOS)
+            if product_box.get('flipped'):
+                product_image = product_image.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
         
-        product_image = product_image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+        with self.timed_stage('composite'):
+            if product_image.mode != 'RGBA':
+                product_image = product_image.convert('RGBA')
+            
+            product_x = round(product_box['x'] - size[0] / 2)
+            product_y = round(product_box['y'] - size[1] / 2)
+            background.paste(product_image, (product_x, product_y), product_image)
         
-        # Ensure product image has transparency (RGBA)
-        if product_image.mode != 'RGBA':
-            product_image = product_image.convert('RGBA')
+        return background
+    
+    def decode_product(self, product_image_path):
+        """Open the product image, decoding oversized sources at a reduced scale
+        JPEGs use draft mode (DCT scaling during decode), other formats a box reduce.
+        At least twice the final size is kept so the LANCZOS pass in center_product
+        gives the same result as from the full-size image
+        """
+        product_image = Image.open(product_image_path)
+        
+        # Smallest size worth decoding: twice the product box
+        min_decode_size = self.product_max_size * 2
+        width, height = product_image.size
+        longest = max(width, height)
         
-        # Ensure background is in RGBA mode for proper alpha blending
-        if background.mode != 'RGBA':
-            background = background.convert('RGBA')
+        if product_image.format == 'JPEG' and longest >= min_decode_size * 2:
+            product_image.draft(product_image.mode, (
+                max(1, width * min_decode_size // longest),
+                max(1, height * min_decode_size // longest)
+            ))
         
-        product_x = (self.background_width - product_image.size[0]) // 2
-        product_y = (self.background_height - product_image.size[1]) // 2
+        # Convert to RGBA to preserve transparency (no white background frame)
+        # RGB is kept and converted to RGBA in center_product
+        if product_image.mode not in ('RGBA', 'RGB'):
+            product_image = product_image.convert('RGBA')
         
-        # Paste product image with alpha channel to blend naturally (no white frame)
-        background.paste(product_image, (product_x, product_y), product_image)
+        factor = max(product_image.size) // min_decode_size
+        if factor >= 2:
+            product_image = product_image.reduce(factor)
         
-        return background
+        return product_image
+    
+    def estimate_memory(self, product_image_path):
+        """Rough peak bytes of rendering a product, read from its header only
+        The source as decode_product() decodes it, plus the RGBA and RGB frames of compose()
+        """
+        try:
+            with Image.open(product_image_path) as product_image:
+                width, height = product_image.size
+                image_format = product_image.format
+        except Exception:
+            # Rendering will fail as fast
+            return 0
+        finally:
+            if hasattr(product_image_path, 'seek'):
+                product_image_path.seek(0)
+        
+        # Same scale as the JPEG draft in decode_product (1/2, 1/4 or 1/8)
+        scale = 1
+        min_decode_size = self.product_max_size * 2
+        if image_format == 'JPEG':
+            while scale < 8 and max(width, height) // (scale * 2) >= min_decode_size:
+                scale *= 2
+        frame_bytes = self.background_width * self.background_height * 4
+        return (width // scale) * (height // scale) * 4 + 3 * frame_bytes
     
     def load_picto(self, picto_path, max_size=100):
-        """Load a picto image, convert to RGBA, and resize preserving aspect ratio"""
+        """Return a picto from the per-worker cache, loading it on first use"""
         try:
-            picto = Image.open(picto_path)
-            if picto.mode != 'RGBA':
-                picto = picto.convert('RGBA')
-            
-            # Resize preserving aspect ratio
-            width, height = picto.size
-            if width > height:
-                new_width = max_size
-                new_height = int((height * max_size) / width)
-            else:
-                new_height = max_size
-                new_width = int((width * max_size) / height)
-            
-            picto = picto.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            return picto
+            return picto_cache.get(picto_path, max_size, self._load_picto)
         except Exception as e:
-            print(f"❌ Error loading picto {picto_path}: {e}")
+            logger.warning('Error loading picto', extra={'path': picto_path, 'error': str(e)})
             return None
     
-    def add_vertical_pictos(self, background, vertical_selections):
-        """Add vertical pictos on the left side of the image
-        Position 1 = BOTTOM, Position 5 = TOP
-        Only renders explicitly selected pictos - no automatic additions
-        """
-        picto_max_size = 130  # Increased size for better visibility
-        x_pos = 20  # X position (left side)
-
-        
-        # Fixed Y positions maintaining same visual spacing between pictos
-        # Original: 100px pictos with 115px spacing between top edges = 15px visual gap
-        # New: 130px pictos, maintaining 15px visual gap = 145px spacing between top edges
-        # Position 1 at BOTTOM, Position 5 at TOP
-       
-        vertical_positions = [
-            575,   # Position 1 - BOTTOM (keep same reference point)
-            430,   # Position 2 (575 - 145 = 430)
-            285,   # Position 3 (430 - 145 = 285)
-            140,   # Position 4 (285 - 145 = 140)
-            5,     # Position 5 - TOP (140 - 145 = -5, but keep at 5 for safety)
-        ]
+    def _load_picto(self, picto_path, max_size):
+        """Crop the picto out of the shared atlas, or decode it if the atlas lacks it"""
+        picto = picto_atlas.get(picto_path, max_size, self._decode_picto)
+        if picto is None:
+            picto = self._decode_picto(picto_path, max_size)
+        return picto
+    
+    def _decode_picto(self, picto_path, max_size):
+        """Load a picto image, convert to RGBA, and resize preserving aspect ratio"""
+        picto = Image.open(picto_path)
+        if picto.mode != 'RGBA':
+            picto = picto.convert('RGBA')
         
-        # Filter out empty strings and None values - only keep explicitly selected pictos
-        # NO automatic additions - only render what the user explicitly selected
-        for i, filename in enumerate(vertical_selections):
-            if filename and filename.strip() and i < len(vertical_positions):
-                filename = filename.strip()
-                picto_path = os.path.join(self.vertical_dir, filename)
-                picto = self.load_picto(picto_path, picto_max_size)
-                if picto:
-                    y_pos = vertical_positions[i]
-                    
-                    if background.mode != 'RGBA':
-                        background = background.convert('RGBA')
-                    
-                    background.paste(picto, (x_pos, y_pos), picto)
+        # Resize preserving aspect ratio
+        width, height = picto.size
+        if width > height:
+            new_width = max_size
+            new_height = int((height * max_size) / width)
+        else:
+            new_height = max_size
+            new_width = int((width * max_size) / height)
         
-        return background
+        picto = picto.resize((new_width, new_height), Image.Resampling.LANCZOS)
+        return picto
     
-    def add_horizontal_pictos(self, background, horizontal_selections):
-        """Add horizontal pictos vertically on the right side of the image
-        Position 1 = BOTTOM, Position 5 = TOP (same Y positions as left vertical pictos)
+    def create_overlay(self, vertical_selections, horizontal_selections):
+        """Build the transparent picto layer shared by every product of a batch
+        Compositing this once per product replaces up to ten picto pastes.
+        Pictos go in the slots of the layout: vertical ones on the left, horizontal ones on the
+        right, position 1 at the bottom
         """
-        picto_max_size = 130  # Increased size for better visibility
-        x_pos = self.background_width - 120  # X position (right side, 120px from right edge)
-        
-        # Same Y positions as left vertical pictos (maintaining same visual spacing)
-        # Original: 100px pictos with 115px spacing between top edges = 15px visual gap
-        # New: 130px pictos, maintaining 15px visual gap = 145px spacing between top edges
-        # Position 1 at BOTTOM, Position 5 at TOP
-        vertical_positions = [
-            575,   # Position 1 - BOTTOM (keep same reference point)
-            430,   # Position 2 (575 - 145 = 430)
-            285,   # Position 3 (430 - 145 = 285)
-            140,   # Position 4 (285 - 145 = 140)
-            5,     # Position 5 - TOP (140 - 145 = -5, but keep at 5 for safety)
-        ]
+        return self.create_layout_overlay(self.plan.get_pictos(
+            self.vertical_dir, self.horizontal_dir, vertical_selections, horizontal_selections
+        ))
+    
+    def create_layout_overlay(self, pictos):
+        """Build the picto layer of a custom layout
+        `pictos` are (path, x, y, size) tuples, drawn in order at their top-left corner
+        """
+        overlay = Image.new('RGBA', (self.background_width, self.background_height), (0, 0, 0, 0))
         
-        for i, (category, filename) in enumerate(horizontal_selections):
-            if category and filename and i < len(vertical_positions):
-                picto_path = os.path.join(self.horizontal_dir, category, filename)
-                picto = self.load_picto(picto_path, picto_max_size)
-                if picto:
-                    y_pos = vertical_positions[i]
-                    
-                    if background.mode != 'RGBA':
-                        background = background.convert('RGBA')
-                    
-                    background.paste(picto, (x_pos, y_pos), picto)
+        for picto_path, x_pos, y_pos, picto_max_size in pictos:
+            picto = self.load_picto(picto_path, picto_max_size)
+            if picto:
+                overlay.alpha_composite(picto, (x_pos, y_pos))
         
-        return background
+        return overlay
     
-    def process_product(self, product_image_path, vertical_selections, horizontal_selections):
-        """Process the product image with vertical and horizontal pictos"""
-        try:
-            # Load product image
-            product_image = Image.open(product_image_path)
-            
-            # Convert to RGBA to preserve transparency (no white background frame)
-            if product_image.mode == 'P':
-                product_image = product_image.convert('RGBA')
-            elif product_image.mode not in ('RGBA', 'RGB'):
-                product_image = product_image.convert('RGBA')
-            elif product_image.mode == 'RGB':
-                # Keep RGB but we'll convert to RGBA in center_product
-                pass
-            
-            # Create background
+    def flatten(self, image):
+        """Convert back to RGB for saving (WebP supports RGB), over a white background"""
+        with self.timed_stage('flatten'):
+            if image.mode == 'RGBA':
+                rgb_image = Image.new('RGB', image.size, (255, 255, 255))
+                rgb_image.paste(image, (0, 0), image)
+                image = rgb_image
+        return image
+    
+    def compose(self, product_image, overlay, product_box=None):
+        """Background, product and picto overlay flattened into the final RGB image"""
+        # Create background
+        with self.timed_stage('composite'):
             background = self.create_background()
-            
-            # Center product on background
+        
+        # Center product on background, or place it where the editor put it
+        if product_box is None:
             background = self.center_product(product_image, background)
+        else:
+            background = self.place_product(product_image, background, product_box)
+        
+        # Add all pictos in a single composite
+        with self.timed_stage('composite'):
+            background.alpha_composite(overlay)
+        
+        return self.flatten(background)
+    
+    def encode_result(self, image, output_name):
+        """Encode the final image as WebP, and its THUMBNAIL_FIELDS sizes, in memory
+        Returns the (storage name, bytes) of the result followed by its thumbnails
+        """
+        base_name = os.path.splitext(os.path.basename(output_name))[0]
+        result_name = f'results/result_{base_name}.webp'
+        with self.timed_stage('encode'):
+            buffer = BytesIO()
+            image.save(buffer, self.output_format, quality=self.output_quality)
+            files = [(result_name, buffer.getvalue())]
+        
+        # Thumbnails for the result pages, downscaled from the in-memory composite
+        # (largest first, each smaller one from the previous)
+        with self.timed_stage('thumbnails'):
+            thumbnail = image
+            for size in sorted(THUMBNAIL_FIELDS.values(), reverse=True):
+                height = max(1, round(image.height * size / image.width))
+                thumbnail = thumbnail.resize((size, height), Image.Resampling.LANCZOS)
+                buffer = BytesIO()
+                thumbnail.save(buffer, self.output_format, quality=self.thumbnail_quality)
+                files.append((get_thumbnail_path(result_name, size), buffer.getvalue()))
+        return files
+    
+    def save_result(self, image, output_name):
+        """Encode the final image with its thumbnails and save them; returns the result name
+        With RESULT_UPLOAD_THREADS the result and its thumbnails are saved at once
+        """
+        files = self.encode_result(image, output_name)
+        executor = get_upload_executor()
+        with self.timed_stage('upload'):
+            if executor is None:
+                for name, content in files:
+                    save_file(self.storage, name, content)
+            else:
+                list(executor.map(lambda file: save_file(self.storage, *file), files))
+        return files[0][0]
+    
+    def record_render(self, seconds):
+        """Report the stage times of a successful render to the metrics"""
+        for stage, stage_seconds in self.stage_times.items():
+            process_metrics.observe('render_stage_seconds', stage_seconds, stage=stage)
+        process_metrics.observe('render_seconds', seconds)
+        process_metrics.inc('images_rendered_total')
+    
+    def process_product(self, product_image_path, vertical_selections, horizontal_selections, overlay=None, output_name=None,
+                        product_box=None):
+        """Process the product image with vertical and horizontal pictos
+        `product_image_path` may also be an open file (e.g. an upload); `output_name`
+        then names the result. Pass the batch overlay from create_overlay() to avoid
+        rebuilding it for every product. `product_box` places the product as in the
+        preview editor (see place_product) instead of centering it
+        """
+        self.stage_times = {}
+        started = time.perf_counter()
+        process_metrics.add('renders_in_flight', 1)
+        try:
+            # Load product image (decoded straight from the stream for open files)
+            with self.timed_stage('decode'):
+                product_image = self.decode_product(product_image_path)
+                # Pillow decodes lazily; force it so the time is not billed to resize
+                product_image.load()
             
-            # Add vertical pictos (left side)
-            background = self.add_vertical_pictos(background, vertical_selections)
-            
-            # Add horizontal pictos (right side, vertical)
-            background = self.add_horizontal_pictos(background, horizontal_selections)
+            if overlay is None:
+                with self.timed_stage('overlay'):
+                    overlay = self.create_overlay(vertical_selections, horizontal_selections)
             
-            # Convert back to RGB for saving (WebP supports RGB)
-            if background.mode == 'RGBA':
-                rgb_background = Image.new('RGB', background.size, (255, 255, 255))
-                rgb_background.paste(background, (0, 0), background)
-                background = rgb_background
+            image = self.compose(product_image, overlay, product_box=product_box)
             
-            # Save the final image as WebP
-            base_name = os.path.splitext(os.path.basename(product_image_path))[0]
-            output_path = f'media/results/result_{base_name}.webp'
-            os.makedirs(os.path.dirname(output_path), exist_ok=True)
-            background.save(output_path, 'WEBP', quality=95)
+            if output_name is None:
+                output_name = getattr(product_image_path, 'name', product_image_path)
+            output_path = self.save_result(image, output_name)
+            # Free the pixels now rather than when the next product replaces them
+            image.close()
+            product_image.close()
             
+            self.record_render(time.perf_counter() - started)
             return output_path
             
-        except Exception as e:
-            print(f"Error processing image: {e}")
-            import traceback
-            traceback.print_exc()
+        except Exception:
+            logger.exception('Error processing image', extra={
+                'product': str(getattr(product_image_path, 'name', product_image_path)),
+            })
+            process_metrics.inc('render_failures_total')
             return None
+        finally:
+            process_metrics.add('renders_in_flight', -1)
+
+
+def render_submission(generator, submission, vertical_selections, horizontal_selections, overlay=None):
+    """Render a stored product submission and save its result image; returns True on success"""
+    product_file = submission.product_image
+    product_file.open('rb')
+    try:
+        fresh_renders = render_products(
+            generator, [submission], [product_file], vertical_selections, horizontal_selections, overlay=overlay
+        )
+    finally:
+        product_file.close()
+    
+    if not submission.result_image:
+        return False
+    
+    with transaction.atomic():
+        submission.save(update_fields=['result_image', *THUMBNAIL_FIELDS])
+        render_cache.store_many(fresh_renders)
+    return True
+
+
+def render_products(generator, submissions, product_files, vertical_selections, horizontal_selections,
+                    overlay=None, batch_id=None, parallel=False):
+    """Render the products of a batch, linking identical earlier renders from the render cache
+    Sets result_image on the (possibly unsaved) submissions and does not write them to the
+    database. `product_files` are the open product files; with `parallel` the renders are
+    fanned out to the process pool, which reads the stored copies instead.
+    Returns the (cache key, result path) pairs to pass to render_cache.store_many()
+    """
+    fresh_renders = []
+    for submission, key, result_path, _ in iter_render_products(
+        generator, submissions, product_files, vertical_selections, horizontal_selections,
+        overlay=overlay, batch_id=batch_id, parallel=parallel
+    ):
+        if store_result(submission, result_path) and key:
+            fresh_renders.append((key, result_path))
+    return fresh_renders
+
+
+def iter_render_products(generator, submissions, product_files, vertical_selections, horizontal_selections,
+                         overlay=None, batch_id=None, parallel=False):
+    """Like render_products() but yields each product as soon as it is done
+    Yields (submission, cache key, result path, render seconds): render cache hits first
+    (with no key, they are already cached), then fresh renders in completion order.
+    The result path is None for failures; store_result() is left to the caller
+    """
+    keys = []
+    output_names = []
+    for submission, product_file in zip(submissions, product_files):
+        if render_cache.is_enabled():
+            key = render_cache.make_key(generator, product_file, vertical_selections, horizontal_selections)
+            keys.append(key)
+            output_names.append(render_cache.get_output_name(submission.product_image.name, key))
+        else:
+            keys.append(None)
+            # Upload names are unique extension included (a.jpg, a.png): keep it in the result name
+            output_names.append(submission.product_image.name.replace('.', '_'))
+    
+    # One query for the whole batch
+    cached_paths = render_cache.lookup_many([key for key in keys if key])
+    
+    pending = []
+    for submission, product_file, key, output_name in zip(submissions, product_files, keys, output_names):
+        if key in cached_paths:
+            yield submission, None, cached_paths[key], 0
+        else:
+            pending.append((submission, product_file, key, output_name))
+    
+    if not pending:
+        return
+    
+    if parallel:
+        for index, result_path, seconds in iter_render_batch(
+            batch_id,
+            [submission.product_image.name for submission, _, _, _ in pending],
+            vertical_selections,
+            horizontal_selections,
+            output_names=[output_name for _, _, _, output_name in pending],
+            generator=generator
+        ):
+            submission, _, key, _ = pending[index]
+            yield submission, key, result_path, seconds
+        return
+    
+    if overlay is None:
+        overlay = generator.create_overlay(vertical_selections, horizontal_selections)
+    
+    for submission, product_file, key, output_name in pending:
+        started = time.perf_counter()
+        product_file.seek(0)
+        result_path = generator.process_product(
+            product_file,
+            vertical_selections,
+            horizontal_selections,
+            overlay=overlay,
+            output_name=output_name
+        )
+        yield submission, key, result_path, time.perf_counter() - started
+
+
+def store_result(submission, result_path):
+    """Set the rendered result on a submission; returns False if rendering failed"""
+    if not result_path:
+        return False
+    
+    submission.result_image = result_path
+    for field, size in THUMBNAIL_FIELDS.items():
+        setattr(submission, field, get_thumbnail_path(submission.result_image.name, size))
+    return True
+
+
+def save_file(storage, name, content):
+    """Save bytes to `storage` under exactly `name`, replacing a previous render
+    `storage` is the 'results' storage, which replaces files atomically (see
+    generator.storage), so other submissions linked to the name never see it missing
+    """
+    return storage.save(name, ContentFile(content, name=name))
+
+
+def create_submissions(submissions):
+    """Insert product submissions in bulk and return them with their primary keys"""
+    created = ProductSubmission.objects.bulk_create(submissions)
+    if created and created[0].pk is None:
+        # Backends without RETURNING (MySQL) leave pks unset; one batch insert keeps id order
+        batch = created[0].batch
+        created = list(batch.products.order_by('-id')[:len(created)])[::-1]
+    return created
+
+
+def bind_upload_form(request):
+    """Parse the upload (its files are written to disk) and validate the product form"""
+    form = ProductSubmissionForm(request.POST, request.FILES)
+    form.is_valid()
+    return form
+
+
+def store_upload(form, files):
+    """Create the batch of a valid product form and store its uploads
+    Returns the batch and its unsaved submissions; in 'queue' mode the submissions and
+    their render jobs are created right away
+    """
+    # Create a batch submission to store the shared picto selections
+    batch = BatchSubmission.objects.create(
+        vertical_pos_1=form.cleaned_data.get('vertical_pos_1') or '',
+        vertical_pos_2=form.cleaned_data.get('vertical_pos_2') or '',
+        vertical_pos_3=form.cleaned_data.get('vertical_pos_3') or '',
+        vertical_pos_4=form.cleaned_data.get('vertical_pos_4') or '',
+        vertical_pos_5=form.cleaned_data.get('vertical_pos_5') or '',
+        horizontal_cat_1=form.cleaned_data.get('horizontal_cat_1') or '',
+        horizontal_file_1=form.cleaned_data.get('horizontal_file_1') or '',
+        horizontal_cat_2=form.cleaned_data.get('horizontal_cat_2') or '',
+        horizontal_file_2=form.cleaned_data.get('horizontal_file_2') or '',
+        horizontal_cat_3=form.cleaned_data.get('horizontal_cat_3') or '',
+        horizontal_file_3=form.cleaned_data.get('horizontal_file_3') or '',
+        horizontal_cat_4=form.cleaned_data.get('horizontal_cat_4') or '',
+        horizontal_file_4=form.cleaned_data.get('horizontal_file_4') or '',
+        horizontal_cat_5=form.cleaned_data.get('horizontal_cat_5') or '',
+        horizontal_file_5=form.cleaned_data.get('horizontal_file_5') or '',
+    )
+    
+    # Save the uploaded files (storage copies them in chunks); the submissions
+    # themselves are written in bulk once the whole batch is ready
+    submissions = []
+    for uploaded_file in files:
+        file_path = default_storage.save(f'products/{uploaded_file.name}', uploaded_file)
+        submissions.append(ProductSubmission(batch=batch, product_image=file_path))
+    
+    if settings.RENDER_MODE == 'queue':
+        # Leave rendering to `manage.py render_worker`
+        with transaction.atomic():
+            submissions = create_submissions(submissions)
+            RenderJob.objects.bulk_create([RenderJob(submission=submission) for submission in submissions])
+    
+    return batch, submissions
+
+
+def render_upload(batch, submissions, files):
+    """Render and save the submissions of an uploaded batch; returns how many succeeded"""
+    # Process each image from the still-open upload instead of reading the stored copy back,
+    # sharing one picto overlay across the batch ('parallel' uses the process pool instead)
+    generator = ProductIconGenerator()
+    fresh_renders = render_products(
+        generator,
+        submissions,
+        files,
+        batch.get_vertical_selections(),
+        batch.get_horizontal_selections(),
+        batch_id=batch.id,
+        parallel=settings.RENDER_MODE == 'parallel'
+    )
+    
+    with transaction.atomic():
+        create_submissions(submissions)
+        render_cache.store_many(fresh_renders)
+    
+    return sum(1 for submission in submissions if submission.result_image)
 
 
-def home(request):
-    """Home page with the product submission form - supports multiple images"""
+async def home(request):
+    """Home page with the product submission form - supports multiple images
+    Async so that, under ASGI, a batch being rendered holds no request thread: the form and
+    the database run through sync_to_async and the render on the bounded render threads
+    """
     if request.method == 'POST':
-        form = ProductSubmissionForm(request.POST, request.FILES)
+        form = await sync_to_async(bind_upload_form)(request)
         if form.is_valid():
             # Get uploaded files (multiple)
             files = request.FILES.getlist('product_images')
             
             if not files:
                 messages.error(request, 'Please select at least one image.')
-                return render(request, 'generator/home.html', {'form': form})
+                return await sync_to_async(render)(request, 'generator/home.html', {'form': form})
+            
+            batch_started = time.perf_counter()
+            process_metrics.inc('batches_total', mode=settings.RENDER_MODE)
+            process_metrics.observe('batch_images', len(files))
             
-            # Create a batch submission to store the shared picto selections
-            batch = BatchSubmission.objects.create(
-                vertical_pos_1=form.cleaned_data.get('vertical_pos_1') or '',
-                vertical_pos_2=form.cleaned_data.get('vertical_pos_2') or '',
-                vertical_pos_3=form.cleaned_data.get('vertical_pos_3') or '',
-                vertical_pos_4=form.cleaned_data.get('vertical_pos_4') or '',
-                vertical_pos_5=form.cleaned_data.get('vertical_pos_5') or '',
-                horizontal_cat_1=form.cleaned_data.get('horizontal_cat_1') or '',
-                horizontal_file_1=form.cleaned_data.get('horizontal_file_1') or '',
-                horizontal_cat_2=form.cleaned_data.get('horizontal_cat_2') or '',
-                horizontal_file_2=form.cleaned_data.get('horizontal_file_2') or '',
-                horizontal_cat_3=form.cleaned_data.get('horizontal_cat_3') or '',
-                horizontal_file_3=form.cleaned_data.get('horizontal_file_3') or '',
-                horizontal_cat_4=form.cleaned_data.get('horizontal_cat_4') or '',
-                horizontal_file_4=form.cleaned_data.get('horizontal_file_4') or '',
-                horizontal_cat_5=form.cleaned_data.get('horizontal_cat_5') or '',
-                horizontal_file_5=form.cleaned_data.get('horizontal_file_5') or '',
-            )
+            batch, submissions = await sync_to_async(store_upload)(form, files)
             
-            # Gather selections from batch
-            vertical_selections = [
-                batch.vertical_pos_1, batch.vertical_pos_2, batch.vertical_pos_3,
-                batch.vertical_pos_4, batch.vertical_pos_5
-            ]
-            horizontal_selections = [
-                (batch.horizontal_cat_1, batch.horizontal_file_1),
-                (batch.horizontal_cat_2, batch.horizontal_file_2),
-                (batch.horizontal_cat_3, batch.horizontal_file_3),
-                (batch.horizontal_cat_4, batch.horizontal_file_4),
-                (batch.horizontal_cat_5, batch.horizontal_file_5),
-            ]
+            if settings.RENDER_MODE == 'queue':
+                process_metrics.observe('batch_seconds', time.perf_counter() - batch_started, mode=settings.RENDER_MODE)
+                logger.info('Batch queued', extra={'batch_id': batch.id, 'images': len(files)})
+                messages.success(request, f'Queued {len(files)} product image(s) for rendering.')
+                return redirect('batch_result', batch_id=batch.id)
             
-            # Process each uploaded image
-            generator = ProductIconGenerator()
-            success_count = 0
+            success_count = await run_in_render_thread(render_upload, batch, submissions, files)
             
-            for uploaded_file in files:
-                # Save the uploaded file
-                file_path = default_storage.save(f'products/{uploaded_file.name}', ContentFile(uploaded_file.read()))
-                full_path = default_storage.path(file_path)
-                
-                # Create product submission
-                submission = ProductSubmission.objects.create(
-                    batch=batch,
-                    product_image=file_path
-                )
-                
-                # Process the image
-                result_path = generator.process_product(
-                    full_path,
-                    vertical_selections,
-                    horizontal_selections
-                )
-                
-                if result_path:
-                    submission.result_image = result_path.replace('media/', '')
-                    submission.save()
-                    success_count += 1
+            process_metrics.observe('batch_seconds', time.perf_counter() - batch_started, mode=settings.RENDER_MODE)
+            logger.info('Batch rendered', extra={
+                'batch_id': batch.id,
+                'images': len(files),
+                'succeeded': success_count,
+                'mode': settings.RENDER_MODE,
+                'seconds': round(time.perf_counter() - batch_started, 3),
+            })
+            if success_count == 0:
+                process_metrics.inc('batch_failures_total', mode=settings.RENDER_MODE)
             
             if success_count > 0:
                 messages.success(request, f'Successfully generated {success_count} product image(s)!')
@@ -307,59 +651,96 @@ def home(request):
     else:
         form = ProductSubmissionForm()
     
-    return render(request, 'generator/home.html', {'form': form})
+    return await sync_to_async(render)(request, 'generator/home.html', {'form': form})
 
 
 def get_picto_data_from_batch(batch):
     """Extract picto data from a batch submission for preview editor
-    Only includes explicitly selected pictos - no automatic additions
+    Placed by the same render plan as the rendered results, with the canvas geometry;
+    only includes explicitly selected pictos - no automatic additions
     """
-    vertical_pictos = []
-    vertical_positions = [575, 430, 285, 140, 5]  # Y positions for vertical pictos (maintaining spacing)
-    
-    # Collect vertical pictos from batch - only include non-empty selections
-    # NO automatic additions - only what the user explicitly selected
-    for i in range(1, 6):
-        filename = getattr(batch, f'vertical_pos_{i}', '') or ''
-        # Filter out empty strings and whitespace-only values
-        if filename and filename.strip():
-            filename = filename.strip()
-            vertical_pictos.append({
-                'url': f'/data/Vertical_pictos/{filename}',
-                'x': 20,
-                'y': vertical_positions[i-1]
-            })
-    
-    horizontal_pictos = []
-    x_pos = 800 - 120  # Right side, 120px from right edge
-    vertical_positions = [575, 430, 285, 140, 5]  # Same Y positions as left vertical pictos (maintaining spacing)
-    
-    for i in range(1, 6):
-        category = getattr(batch, f'horizontal_cat_{i}', '') or ''
-        filename = getattr(batch, f'horizontal_file_{i}', '') or ''
-        if category and filename:
-            horizontal_pictos.append({
-                'url': f'/data/horizantal_Pictos/{category}/{filename}',
-                'x': x_pos,
-                'y': vertical_positions[i-1]
-            })
-    
+    if batch is None:
+        vertical_selections, horizontal_selections = [], []
+    else:
+        vertical_selections = batch.get_vertical_selections()
+        horizontal_selections = batch.get_horizontal_selections()
     return {
-        'vertical': vertical_pictos,
-        'horizontal': horizontal_pictos,
+        **get_render_plan().get_editor_data(vertical_selections, horizontal_selections),
         'background_url': '/backgrounds/background.jpg'
     }
 
 
+def resolve_picto_url(generator, url):
+    """Map a /data/ picto URL of the preview editor to its file, refusing anything outside Data/"""
+    if not isinstance(url, str) or not url.startswith('/data/'):
+        raise ValueError(f'Invalid picto URL: {url}')
+    
+    data_dir = os.path.realpath(generator.data_dir)
+    picto_path = os.path.realpath(os.path.join(data_dir, unquote(url[len('/data/'):])))
+    if (not picto_path.startswith(data_dir + os.sep) or not picto_path.lower().endswith(PICTO_EXTENSIONS)
+            or not os.path.isfile(picto_path)):
+        raise ValueError(f'Invalid picto URL: {url}')
+    return picto_path
+
+
+def parse_layout(generator, layout):
+    """Validate a preview editor layout and return (pictos, product_box)
+    The layout has the shape of get_picto_data_from_batch(): `vertical` and `horizontal`
+    lists of {url, x, y} plus an optional picto `size` (default: the layout's), and an optional
+    `product` box {x, y, width, height, flipped} or {x, y, scale_x, scale_y, flipped} (default:
+    centered as usual), see place_product()
+    """
+    if not isinstance(layout, dict):
+        raise ValueError('Layout must be a JSON object.')
+    
+    width, height = generator.background_width, generator.background_height
+    picto_entries = []
+    for side in ('vertical', 'horizontal'):
+        entries = layout.get(side) or []
+        if not isinstance(entries, list):
+            raise ValueError(f'`{side}` must be a list.')
+        picto_entries.extend(entries)
+    if len(picto_entries) > 20:
+        raise ValueError('Too many pictos.')
+    
+    pictos = []
+    for picto in picto_entries:
+        try:
+            x_pos, y_pos = int(picto['x']), int(picto['y'])
+            picto_max_size = int(picto.get('size', generator.plan.picto_size))
+        except (KeyError, TypeError, ValueError, AttributeError):
+            raise ValueError('Pictos need numeric x, y and size.')
+        if not (0 <= x_pos < width and 0 <= y_pos < height and 1 <= picto_max_size <= max(width, height)):
+            raise ValueError('Picto position or size out of the canvas.')
+        pictos.append((resolve_picto_url(generator, picto.get('url')), x_pos, y_pos, picto_max_size))
+    
+    product_box = layout.get('product')
+    if product_box is not None:
+        size_keys = ('scale_x', 'scale_y') if 'scale_x' in product_box else ('width', 'height')
+        try:
+            product_box = {
+                **{key: float(product_box[key]) for key in ('x', 'y', *size_keys)},
+                'flipped': bool(product_box.get('flipped')),
+            }
+        except (KeyError, TypeError, ValueError, AttributeError):
+            raise ValueError('`product` needs numeric x, y and either width and height or scale_x and scale_y.')
+        if 'scale_x' in product_box:
+            size_ok = 0 < product_box['scale_x'] <= 20 and 0 < product_box['scale_y'] <= 20
+        else:
+            size_ok = 1 <= product_box['width'] <= 2 * width and 1 <= product_box['height'] <= 2 * height
+        if not (size_ok and 0 <= product_box['x'] <= width and 0 <= product_box['y'] <= height):
+            raise ValueError('Product position or size out of the canvas.')
+    
+    return pictos, product_box
+
+
 def result(request, submission_id):
     """Display the result page with a single generated image"""
     try:
-        submission = ProductSubmission.objects.get(id=submission_id)
+        submission = ProductSubmission.objects.select_related('batch').get(id=submission_id)
         
         # Get picto data for preview editor
-        picto_data = {}
-        if submission.batch:
-            picto_data = get_picto_data_from_batch(submission.batch)
+        picto_data = get_picto_data_from_batch(submission.batch)
         
         return render(request, 'generator/result.html', {
             'submission': submission,
@@ -374,7 +755,13 @@ def batch_result(request, batch_id):
     """Display results for a batch of processed images"""
     try:
         batch = BatchSubmission.objects.get(id=batch_id)
-        products = batch.products.all()
+        products = batch.products.select_related('render_job')
+        
+        # Products still waiting for `manage.py render_worker`
+        pending_count = RenderJob.objects.filter(
+            submission__batch=batch,
+            status__in=[RenderJob.STATUS_PENDING, RenderJob.STATUS_RUNNING]
+        ).count()
         
         # Get picto data for preview editor
         picto_data = get_picto_data_from_batch(batch)
@@ -382,6 +769,7 @@ def batch_result(request, batch_id):
         return render(request, 'generator/batch_result.html', {
             'batch': batch,
             'products': products,
+            'pending_count': pending_count,
             'picto_data': json.dumps(picto_data)
         })
     except BatchSubmission.DoesNotExist:
@@ -389,6 +777,385 @@ def batch_result(request, batch_id):
         return redirect('home')
 
 
+def parse_history_cursor(cursor):
+    """(created_at, id) of the last batch of the previous page, from a `before` cursor"""
+    created_at, _, batch_id = cursor.rpartition('_')
+    try:
+        return datetime.fromisoformat(created_at), int(batch_id)
+    except ValueError:
+        return None
+
+
+def batch_history(request):
+    """Browse past batches, newest first, optionally filtered on a vertical and/or horizontal picto
+    Keyset pagination on (created_at, id) and a constant number of queries per page,
+    however many batches there are
+    """
+    vertical = request.GET.get('vertical', '').strip()
+    horizontal = request.GET.get('horizontal', '').strip()
+    # "category/file" as the form sends it, or a bare file name matching it in any category
+    category, _, horizontal_file = horizontal.rpartition('/')
+    
+    batches = BatchSubmission.objects.all()
+    cursor = parse_history_cursor(request.GET.get('before', ''))
+    if cursor:
+        created_at, batch_id = cursor
+        batches = batches.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=batch_id))
+    
+    ordering = ('-created_at', '-id')
+    limit = HISTORY_PAGE_SIZE + 1
+    vertical_positions = [Q(**{f'vertical_pos_{i}': vertical}) for i in range(1, 6)]
+    horizontal_positions = [
+        Q(**{f'horizontal_file_{i}': horizontal_file, **({f'horizontal_cat_{i}': category} if category else {})})
+        for i in range(1, 6)
+    ]
+    
+    if vertical or horizontal_file:
+        # A picto matches at any of the five positions: one query per position, each walking
+        # its (position, created_at, id) index for a page at most, merged here
+        if vertical:
+            branches = vertical_positions
+            other = Q()
+            if horizontal_file:
+                for position in horizontal_positions:
+                    other |= position
+        else:
+            branches, other = horizontal_positions, Q()
+        
+        keys = set()
+        for branch in branches:
+            keys.update(batches.filter(branch, other).order_by(*ordering).values_list('created_at', 'id')[:limit])
+        batches = BatchSubmission.objects.filter(id__in=[batch_id for _, batch_id in sorted(keys, reverse=True)[:limit]])
+    
+    product_count = ProductSubmission.objects.filter(batch=OuterRef('pk')).order_by().values('batch').annotate(
+        count=Count('id')
+    ).values('count')
+    page = list(
+        batches.order_by(*ordering)
+        .annotate(product_count=Subquery(product_count))
+        .prefetch_related(Prefetch(
+            'products',
+            queryset=ProductSubmission.objects.order_by('id')[:HISTORY_PREVIEW_COUNT],
+            to_attr='preview_products',
+        ))[:limit]
+    )
+    
+    filters = {key: value for key, value in (('vertical', vertical), ('horizontal', horizontal)) if value}
+    next_query = None
+    if len(page) > HISTORY_PAGE_SIZE:
+        page = page[:HISTORY_PAGE_SIZE]
+        last = page[-1]
+        next_query = urlencode({**filters, 'before': f'{last.created_at.isoformat()}_{last.id}'})
+    
+    for batch in page:
+        batch.vertical_pictos = [filename for filename in batch.get_vertical_selections() if filename]
+        batch.horizontal_pictos = [
+            f'{picto_category}/{filename}' for picto_category, filename in batch.get_horizontal_selections()
+            if picto_category and filename
+        ]
+    
+    return render(request, 'generator/history.html', {
+        'batches': page,
+        'vertical': vertical,
+        'horizontal': horizontal,
+        'vertical_choices': picto_catalog.get_vertical_pictos(),
+        'horizontal_choices': [
+            (picto_category, picto_catalog.get_horizontal_pictos(picto_category))
+            for picto_category in picto_catalog.get_categories()
+        ],
+        'is_first_page': cursor is None,
+        'first_query': urlencode(filters),
+        'next_query': next_query,
+    })
+
+
+def get_thumbnail_urls(product):
+    """{size: url} of the thumbnails a product has"""
+    return {
+        size: getattr(product, field).url
+        for field, size in THUMBNAIL_FIELDS.items() if getattr(product, field)
+    }
+
+
+async def batch_status(request, batch_id):
+    """API endpoint reporting render progress of a batch for polling
+    Async: polls never wait for a thread while batches are being rendered
+    """
+    try:
+        batch = await BatchSubmission.objects.aget(id=batch_id)
+    except BatchSubmission.DoesNotExist:
+        return JsonResponse({'error': 'Batch not found.'}, status=404)
+    
+    counts = {status: 0 for status, _ in RenderJob.STATUS_CHOICES}
+    products = []
+    
+    async for product in batch.products.select_related('render_job').order_by('id'):
+        try:
+            status = product.render_job.status
+        except RenderJob.DoesNotExist:
+            # Rendered synchronously inside the upload request
+            status = RenderJob.STATUS_DONE if product.result_image else RenderJob.STATUS_FAILED
+        counts[status] += 1
+        products.append({
+            'id': product.id,
+            'status': status,
+            'result_url': product.result_image.url if product.result_image else None,
+            'thumbnail_urls': get_thumbnail_urls(product),
+        })
+    
+    return JsonResponse({
+        'batch_id': batch.id,
+        'total': len(products),
+        **counts,
+        'complete': counts[RenderJob.STATUS_PENDING] == 0 and counts[RenderJob.STATUS_RUNNING] == 0,
+        'products': products,
+    })
+
+
+def compile_layout(generator, layout, batch_scope=False):
+    """Validate a preview editor layout into the render data shared by its products
+    Returns {key, pictos, product} (JSON, so render jobs can carry it); raises ValueError.
+    With `batch_scope`, an absolute product box is fitted to each product (see place_product)
+    """
+    pictos, product_box = parse_layout(generator, layout)
+    if product_box is not None and batch_scope and 'scale_x' not in product_box:
+        # A box drawn around one product would stretch products of another aspect ratio
+        product_box['fit'] = True
+    
+    # Names custom results apart from the (possibly shared) default renders
+    layout_key = hashlib.sha256(json.dumps(
+        [pictos, product_box, generator.get_render_settings()], sort_keys=True
+    ).encode()).hexdigest()
+    return {'key': layout_key, 'pictos': [list(picto) for picto in pictos], 'product': product_box}
+
+
+def prepare_layout(layout, batch_scope=False):
+    """The generator and compile_layout() layout of a re-render request
+    Both read the render configuration and picto files: run it off the event loop
+    """
+    generator = ProductIconGenerator()
+    return generator, compile_layout(generator, layout, batch_scope)
+
+
+def get_layout_output_name(submission, layout):
+    return render_cache.get_output_name(submission.product_image.name, layout['key'])
+
+
+def render_submission_layout(generator, submission, layout, overlay=None):
+    """Re-render a stored submission with a compile_layout() layout and save its result
+    Returns True on success
+    """
+    product_file = submission.product_image
+    try:
+        product_file.open('rb')
+    except (OSError, ValueError) as e:
+        # ValueError: the upload was removed by `manage.py prune_media --upload-days`
+        logger.warning('Error opening product', extra={'product': product_file.name, 'error': str(e)})
+        return False
+    
+    if overlay is None:
+        overlay = generator.create_layout_overlay(layout['pictos'])
+    try:
+        result_path = generator.process_product(
+            product_file, [], [],
+            overlay=overlay,
+            output_name=get_layout_output_name(submission, layout),
+            product_box=layout['product'],
+        )
+    finally:
+        product_file.close()
+    
+    if not store_result(submission, result_path):
+        return False
+    submission.save(update_fields=['result_image', *THUMBNAIL_FIELDS])
+    return True
+
+
+def render_layout_products(generator, submissions, layout, parallel=False):
+    """Re-render submissions with a compile_layout() layout; returns the ids that failed
+    The picto layer is built once and shared by every product; with `parallel` the
+    products are spread over the process pool under RENDER_MEMORY_BUDGET
+    """
+    if not parallel:
+        overlay = generator.create_layout_overlay(layout['pictos'])
+        return [
+            submission.id for submission in submissions
+            if not render_submission_layout(generator, submission, layout, overlay)
+        ]
+    
+    stored = [submission for submission in submissions if submission.product_image]
+    failed = [submission.id for submission in submissions if not submission.product_image]
+    rendered = []
+    for index, result_path, _ in iter_render_batch(
+        f'layout-{layout["key"]}',
+        [submission.product_image.name for submission in stored],
+        [], [],
+        output_names=[get_layout_output_name(submission, layout) for submission in stored],
+        generator=generator,
+        layout=layout
+    ):
+        if store_result(stored[index], result_path):
+            rendered.append(stored[index])
+        else:
+            failed.append(stored[index].id)
+    
+    ProductSubmission.objects.bulk_update(rendered, ['result_image', *THUMBNAIL_FIELDS])
+    return failed
+
+
+def queue_layout(submissions, layout):
+    """Queue layout re-renders for `manage.py render_worker`, reusing the submissions' jobs
+    Returns False, queuing nothing, while one of the submissions is still being rendered
+    """
+    with transaction.atomic():
+        jobs = RenderJob.objects.select_for_update().filter(submission__in=submissions)
+        if jobs.filter(status__in=[RenderJob.STATUS_PENDING, RenderJob.STATUS_RUNNING]).exists():
+            return False
+        
+        queued = set(jobs.values_list('submission_id', flat=True))
+        jobs.update(
+            status=RenderJob.STATUS_PENDING, layout=layout, attempts=0, worker='', error='',
+            started_at=None, finished_at=None,
+        )
+        RenderJob.objects.bulk_create([
+            RenderJob(submission=submission, layout=layout)
+            for submission in submissions if submission.id not in queued
+        ])
+    return True
+
+
+async def render_layout(request, batch_id=None, submission_id=None):
+    """API endpoint re-rendering one submission or a whole batch with a custom layout
+    The JSON body is a layout as accepted by parse_layout(); results replace the
+    submissions' result images. Dispatched like uploads: with RENDER_MODE=queue the products
+    become render jobs (202, poll `status_url`), otherwise they are rendered on the render
+    threads, across the process pool in 'parallel' mode, at most RENDER_LAYOUT_MAX_PRODUCTS
+    per request. Async: a batch being re-rendered holds no request thread
+    """
+    # By hand: require_POST only supports async views from Django 5.0
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    
+    try:
+        layout = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid JSON.'}, status=400)
+    
+    if submission_id is not None:
+        submissions = ProductSubmission.objects.filter(id=submission_id)
+    else:
+        submissions = ProductSubmission.objects.filter(batch_id=batch_id).order_by('id')
+    submissions = [submission async for submission in submissions]
+    if not submissions:
+        return JsonResponse({'error': 'Nothing to render.'}, status=404)
+    
+    try:
+        generator, layout = await run_in_render_thread(prepare_layout, layout, batch_scope=batch_id is not None)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    
+    if settings.RENDER_MODE == 'queue':
+        if not await sync_to_async(queue_layout)(submissions, layout):
+            return JsonResponse({'error': 'Products are still being rendered, try again later.'}, status=409)
+        status_batch_id = batch_id or submissions[0].batch_id
+        return JsonResponse({
+            'queued': len(submissions),
+            'status_url': reverse('batch_status', args=[status_batch_id]) if status_batch_id else None,
+        }, status=202)
+    
+    max_products = getattr(settings, 'RENDER_LAYOUT_MAX_PRODUCTS', 100)
+    if max_products and len(submissions) > max_products:
+        return JsonResponse({
+            'error': f'Too many products to render in one request (at most {max_products}).'
+        }, status=413)
+    
+    failed = await run_in_render_thread(
+        render_layout_products, generator, submissions, layout, parallel=settings.RENDER_MODE == 'parallel'
+    )
+    rendered = [submission for submission in submissions if submission.id not in failed]
+    
+    return JsonResponse({
+        'rendered': len(rendered),
+        'failed': failed,
+        'products': [
+            {
+                'id': submission.id,
+                'result_url': submission.result_image.url,
+                'thumbnail_urls': get_thumbnail_urls(submission),
+            }
+            for submission in rendered
+        ],
+    })
+
+
+def get_archive_name(requested_name, result_name, used_names):
+    """Name of a result inside the batch archive, optionally chosen by the user"""
+    base_name, ext = os.path.splitext(os.path.basename(result_name))
+    
+    if requested_name:
+        # Same rules as the single image download
+        requested_name = re.sub(r'[<>:"/\\|?*]', '_', requested_name).strip()
+        if requested_name.endswith(ext):
+            requested_name = requested_name[:-len(ext)]
+        base_name = requested_name or base_name
+    
+    name = f'{base_name}{ext}'
+    counter = 2
+    while name in used_names:
+        name = f'{base_name}_{counter}{ext}'
+        counter += 1
+    used_names.add(name)
+    return name
+
+
+def get_streaming_content(request, iterator):
+    """Content for a StreamingHttpResponse over blocking `iterator`
+    Under ASGI it is advanced chunk by chunk on the render threads (see
+    iterate_in_render_thread), so the response streams instead of being buffered
+    whole; WSGI iterates it directly.
+    """
+    if isinstance(request, ASGIRequest):
+        return iterate_in_render_thread(iterator)
+    return iterator
+
+
+def batch_download(request, batch_id):
+    """Stream a ZIP of every result of a batch
+    
+    `filename_<product id>` parameters optionally rename results inside the archive.
+    """
+    try:
+        batch = BatchSubmission.objects.get(id=batch_id)
+    except BatchSubmission.DoesNotExist:
+        messages.error(request, 'Batch not found.')
+        return redirect('home')
+    
+    products = list(
+        batch.products.exclude(result_image='').exclude(result_image__isnull=True)
+        .only('id', 'result_image', 'created_at').order_by('id')
+    )
+    if not products:
+        messages.error(request, 'No results to download yet.')
+        return redirect('batch_result', batch_id=batch.id)
+    
+    names = request.POST if request.method == 'POST' else request.GET
+    used_names = set()
+    entries = [
+        (
+            get_archive_name(names.get(f'filename_{product.id}'), product.result_image.name, used_names),
+            product.result_image.name,
+            product.created_at.timetuple()[:6],
+        )
+        for product in products
+    ]
+    
+    response = StreamingHttpResponse(
+        get_streaming_content(request, stream_zip(entries)), content_type='application/zip'
+    )
+    response['Content-Disposition'] = f'attachment; filename="batch_{batch.id}.zip"'
+    return response
+
+
 def get_horizontal_files(request):
     """API endpoint to get files for a horizontal category"""
     category = request.GET.get('category', '')
@@ -396,12 +1163,28 @@ def get_horizontal_files(request):
     if not category:
         return JsonResponse({'files': []})
     
-    files = get_horizontal_files_for_category(category)
-    
     # Return list of dicts with value and display name
-    file_choices = []
-    for f in files:
-        display_name = os.path.splitext(f)[0].replace('_', ' ').replace('-', ' ')
-        file_choices.append({'value': f, 'label': display_name})
+    file_choices = [
+        {'value': f, 'label': display_name}
+        for f, display_name in picto_catalog.get_horizontal_pictos(category)
+    ]
     
     return JsonResponse({'files': file_choices})
+
+
+@require_GET
+@cache_control(public=True, max_age=60)
+@condition(etag_func=lambda request: picto_catalog.get_json()[1])
+def picto_catalog_api(request):
+    """API endpoint returning every vertical picto and horizontal category/file in one response
+
+    The ETag is derived from the content, so clients revalidate with If-None-Match
+    and get a 304 until the picto set changes.
+    """
+    body, _ = picto_catalog.get_json()
+    return HttpResponse(body, content_type='application/json')
+
+
+def metrics(request):
+    """Prometheus metrics of every process on this host, in the text exposition format"""
+    return HttpResponse(collect_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
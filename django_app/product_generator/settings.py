@@ -80,6 +80,10 @@ else:
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
             'NAME': BASE_DIR / 'db.sqlite3',
+            'OPTIONS': {
+                # Wait for other gunicorn workers' write transactions instead of failing
+                'timeout': 20,
+            },
         }
     }
 
@@ -116,5 +120,140 @@ STATICFILES_DIRS = [
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Where uploads and results are stored: 'filesystem' (MEDIA_ROOT) or 's3', any
+# S3-compatible service through django-storages (MinIO: set AWS_S3_ENDPOINT_URL);
+# credentials come from AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY
+MEDIA_STORAGE = os.getenv('MEDIA_STORAGE', 'filesystem')
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    # Result images and thumbnails: saved under their exact name, atomically replacing
+    # a previous render (generator.storage)
+    'results': {
+        'BACKEND': 'generator.storage.ResultFileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+}
+if MEDIA_STORAGE == 's3':
+    S3_OPTIONS = {
+        'bucket_name': os.getenv('AWS_STORAGE_BUCKET_NAME', ''),
+        'endpoint_url': os.getenv('AWS_S3_ENDPOINT_URL') or None,
+        'region_name': os.getenv('AWS_S3_REGION_NAME') or None,
+        'custom_domain': os.getenv('AWS_S3_CUSTOM_DOMAIN') or None,
+        'querystring_auth': os.getenv('AWS_QUERYSTRING_AUTH', 'True').lower() == 'true',
+    }
+    STORAGES['default'] = {
+        'BACKEND': 'storages.backends.s3.S3Storage',
+        # Uploads with the same file name get distinct names, as on the filesystem
+        'OPTIONS': {**S3_OPTIONS, 'file_overwrite': False},
+    }
+    STORAGES['results'] = {
+        'BACKEND': 'storages.backends.s3.S3Storage',
+        # A PUT replaces the object atomically
+        'OPTIONS': {**S3_OPTIONS, 'file_overwrite': True},
+    }
+
+# Threads per process saving the files of a result (the image and its thumbnails) at
+# once (0: one file after the other); worth raising with object storage, where each
+# file is a network round trip. Products are still saved one after the other
+RESULT_UPLOAD_THREADS = int(os.getenv('RESULT_UPLOAD_THREADS', '0'))
+
+# Layout of the rendered images, among the "layouts" of icon_config.json: canvas size,
+# product box and picto slots ('default' is 800x800, 'marketplace' 1200x1200)
+RENDER_LAYOUT = os.getenv('RENDER_LAYOUT', 'default')
+
+# Rendering mode: 'sync' renders inside the upload request, 'parallel' renders
+# the batch across a process pool, 'queue' stores RenderJob rows for
+# `manage.py render_worker` to process
+RENDER_MODE = os.getenv('RENDER_MODE', 'sync')
+
+# Render processes per web worker in 'parallel' mode (0 = one per CPU)
+RENDER_POOL_WORKERS = int(os.getenv('RENDER_POOL_WORKERS', '0'))
+
+# Threads per web process rendering uploads in 'sync' and 'parallel' mode (0 = one per CPU);
+# further uploads wait for a free thread instead of competing for the CPU
+RENDER_THREADS = int(os.getenv('RENDER_THREADS', '0'))
+
+# Products a preview editor layout re-renders within the request in 'sync' and 'parallel'
+# mode (0 = no limit); larger batches need RENDER_MODE=queue
+RENDER_LAYOUT_MAX_PRODUCTS = int(os.getenv('RENDER_LAYOUT_MAX_PRODUCTS', '100'))
+
+# Estimated bytes of decoded images the renders of one batch may hold at once: in
+# 'parallel' mode products are only handed to the pool while they fit (0 = no limit).
+# 'sync' and 'queue' mode are not budgeted, they render one product at a time per
+# render thread or worker
+RENDER_MEMORY_BUDGET = int(os.getenv('RENDER_MEMORY_BUDGET', str(1024 * 1024 * 1024)))
+
+# Rendering caches (per worker process)
+PICTO_CACHE_MAX_BYTES = int(os.getenv('PICTO_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+# Seconds between checks of the picto folders for added/removed pictos
+PICTO_CATALOG_CHECK_INTERVAL = float(os.getenv('PICTO_CATALOG_CHECK_INTERVAL', '5'))
+
+# Pre-resized pictos in one memory-mapped file shared by the processes of a host
+# (`manage.py build_picto_atlas`, rebuilt automatically when Data/ changes)
+PICTO_ATLAS_ENABLED = os.getenv('PICTO_ATLAS_ENABLED', 'True').lower() == 'true'
+PICTO_ATLAS_DIR = os.getenv('PICTO_ATLAS_DIR', str(BASE_DIR / 'cache'))
+# Longest side of atlas pictos besides the sizes of RENDER_LAYOUT (e.g. sizes set in the editor)
+PICTO_ATLAS_SIZES = [int(size) for size in os.getenv('PICTO_ATLAS_SIZES', '').split(',') if size]
+
+# Content-addressed cache of rendered results (shared through the database)
+RENDER_CACHE_ENABLED = os.getenv('RENDER_CACHE_ENABLED', 'True').lower() == 'true'
+RENDER_CACHE_MAX_BYTES = int(os.getenv('RENDER_CACHE_MAX_BYTES', str(1024 * 1024 * 1024)))
+
+# Retention (`manage.py prune_media`): batches older than BATCH_RETENTION_DAYS are deleted
+# with their files, and uploads of rendered products older than UPLOAD_RETENTION_DAYS
+# (0 keeps them); the command paces itself to MEDIA_GC_IO_BUDGET filesystem ops/second
+BATCH_RETENTION_DAYS = int(os.getenv('BATCH_RETENTION_DAYS', '0'))
+UPLOAD_RETENTION_DAYS = int(os.getenv('UPLOAD_RETENTION_DAYS', '0'))
+MEDIA_GC_IO_BUDGET = int(os.getenv('MEDIA_GC_IO_BUDGET', '200'))
+
+# Bulk generation API (/api/v1/generate/): comma-separated bearer tokens, the API is
+# disabled when empty, and the directories server-local product paths may be read from
+API_TOKENS = [token.strip() for token in os.getenv('API_TOKENS', '').split(',') if token.strip()]
+API_LOCAL_ROOTS = [path for path in os.getenv('API_LOCAL_ROOTS', '').split(os.pathsep) if path]
+
+# Maximum number of files in one upload (product form and bulk API)
+DATA_UPLOAD_MAX_NUMBER_FILES = int(os.getenv('DATA_UPLOAD_MAX_NUMBER_FILES', '500'))
+
+# Metrics: every process writes its own file here and /metrics merges them
+# (default: a directory in the system temp dir, shared by the processes of a host)
+METRICS_DIR = os.getenv('METRICS_DIR', '')
+# Off for processes whose renders are not production traffic (bench_render turns it off)
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'True').lower() == 'true'
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '1'))
+
+# Logging: one JSON object per line in production, plain lines while debugging
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text' if DEBUG else 'json')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {
+            '()': 'generator.log.JsonFormatter',
+        },
+        'text': {
+            'format': '%(asctime)s %(levelname)s %(name)s: %(message)s',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': LOG_FORMAT,
+        },
+    },
+    'loggers': {
+        'generator': {
+            'handlers': ['console'],
+            'level': LOG_LEVEL,
+            'propagate': False,
+        },
+    },
+}
+
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField' 
\ No newline at end of file